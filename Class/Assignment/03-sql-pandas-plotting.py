@@ -16,9 +16,8 @@ get_ipython().system("wget 'https://dataquest.io/blog/large_files/hubway.db'")
 
 import sqlite3
 import pandas as pd
+from hubway import run_query  # pooled connections + cached results
 db = sqlite3.connect('hubway.db')
-def run_query(query):
-    return pd.read_sql_query(query,db)
 
 
 # In[ ]:
@@ -16,9 +16,8 @@ get_ipython().system("wget 'https://dataquest.io/blog/large_files/hubway.db'")
 
 import sqlite3
 import pandas as pd
+from hubway import run_query  # pooled connections + cached results
 db = sqlite3.connect('hubway.db')
-def run_query(query):
-    return pd.read_sql_query(query,db)
 
 
 # In[ ]:
@@ -300,6 +299,8 @@ import sqlite3
 import pandas as pd
 import folium
 from folium import plugins
+import map_layers  # one vectorized layer per DataFrame instead of iterrows()
+from hubway import run_query  # summaries, pooled connections, cache
 db = sqlite3.connect('hubway.db')
 get_ipython().run_line_magic('matplotlib', 'inline')
 
@@ -328,9 +329,7 @@ stops_map
 
 stops_map = folium.Map(location=[42.34,-71.10], zoom_start=12)
 
-marker_cluster = folium.plugins.MarkerCluster().add_to(stops_map)
-for name, row in df.iterrows():
-    folium.Marker([row["lat"], row["lng"]], popup=row["station"]).add_to(marker_cluster)
+map_layers.markers(df, popup="station").add_to(stops_map)
 
 stops_map
 
@@ -338,7 +337,7 @@ stops_map
 # In[ ]:
 
 
-[[row["lat"], row["lng"]] for name, row in df.iterrows()]
+map_layers.heat_data(df)
 
 
 # In[ ]:
@@ -346,8 +345,7 @@ stops_map
 
 stops_heatmap = folium.Map(location=[42.34,-71.10], zoom_start=14)
 
-stops_heatmap.add_child(folium.plugins.HeatMap([[row["lat"], row["lng"]]
-                                                   for name, row in df.iterrows()]))
+stops_heatmap.add_child(map_layers.heatmap(df))
 
 stops_heatmap
 
@@ -388,8 +386,7 @@ FROM stations
 ''',db)
 
 stops_heatmap = folium.Map(location=[centerLat,centerLng], zoom_start=13)
-stops_heatmap.add_child(folium.plugins.HeatMap([[row["lat"], row["lng"]]
-                                                   for name, row in df.iterrows()]))
+stops_heatmap.add_child(map_layers.heatmap(df))
 
 stops_heatmap
 
@@ -438,8 +435,7 @@ df
 
 
 stops_heatmap = folium.Map(location=[centerLat,centerLng], zoom_start=13)
-stops_heatmap.add_child(folium.plugins.HeatMap([[row["lat"], row["lng"], row["Count"]]
-                                                   for name, row in df.iterrows()]))
+stops_heatmap.add_child(map_layers.heatmap(df, weight="Count"))
 
 stops_heatmap
 
@@ -447,9 +443,7 @@ stops_heatmap
 # In[ ]:
 
 
-marker_cluster = folium.plugins.MarkerCluster().add_to(stops_heatmap)
-for name, row in df.iterrows():
-    folium.Marker([row["lat"], row["lng"]], popup=row["Count"]).add_to(marker_cluster)
+map_layers.markers(df, popup="Count", tooltip="Station").add_to(stops_heatmap)
 
 stops_heatmap
 
@@ -471,12 +465,9 @@ df.sort_values("Count",ascending=True)[-20:].plot.barh(x='Station',y='Count')
 
 df2 = df.sort_values("Count",ascending=True)[-20:]
 stops_heatmap = folium.Map(location=[centerLat,centerLng], zoom_start=13)
-stops_heatmap.add_child(folium.plugins.HeatMap([[row["lat"], row["lng"], row["Count"]]
-                                                   for name, row in df2.iterrows()]))
+stops_heatmap.add_child(map_layers.heatmap(df2, weight="Count"))
 
-marker_cluster = folium.plugins.MarkerCluster().add_to(stops_heatmap)
-for name, row in df2.iterrows():
-    folium.Marker([row["lat"], row["lng"]], popup=row["Count"]).add_to(marker_cluster)
+map_layers.markers(df2, popup="Count", tooltip="Station").add_to(stops_heatmap)
 
 stops_heatmap
 
@@ -490,28 +481,29 @@ stops_heatmap.save('stops.html')
 # In[ ]:
 
 
-df = pd.read_sql_query('''
-SELECT duration
-FROM trips;
-''', db)
+# Where every trip starts, binned per zoom level so that the page only
+# carries the non-empty grid cells of each level.
+import hubway_grid
+trips_heatmap = folium.Map(location=[centerLat,centerLng], zoom_start=13)
+trips_heatmap.add_child(map_layers.zoom_heatmap(hubway_grid.trip_grid('start').levels()))
 
-
-# In[ ]:
-
-
-df2 = df.copy()
+trips_heatmap
 
 
 # In[ ]:
 
 
-df[['duration']].hist()
+# Bin the durations inside SQLite instead of pulling every trip into pandas.
+from hubway import duration_histogram
+counts, edges = duration_histogram(10)
+pd.Series(edges[:-1]).plot.hist(bins=edges, weights=counts)
 
 
 # In[ ]:
 
 
-df.hist(bins=100)
+counts, edges = duration_histogram(100)
+pd.Series(edges[:-1]).plot.hist(bins=edges, weights=counts)
 
 
 # In[ ]:
@@ -537,29 +529,22 @@ WHERE duration < 30*60;
 # In[ ]:
 
 
-df[df['duration']<600].duration.hist()
+counts, edges = duration_histogram(10, where='duration < 600')
+pd.Series(edges[:-1]).plot.hist(bins=edges, weights=counts)
 
 
 # In[ ]:
 
 
-df = pd.read_sql_query('''
-SELECT duration
-FROM trips
-WHERE duration < 600;
-''', db)
-df.hist(bins=50)
+counts, edges = duration_histogram(50, where='duration < 600')
+pd.Series(edges[:-1]).plot.hist(bins=edges, weights=counts)
 
 
 # In[ ]:
 
 
-df = pd.read_sql_query('''
-SELECT duration
-FROM trips
-WHERE duration > 400 and duration < 500;
-''', db)
-df.hist(bins=50)
+counts, edges = duration_histogram(50, where='duration > 400 and duration < 500')
+pd.Series(edges[:-1]).plot.hist(bins=edges, weights=counts)
 
 
 # In[ ]:
@@ -575,41 +560,33 @@ WHERE duration = 480.0;
 # In[ ]:
 
 
-df = pd.read_sql_query('''
-SELECT duration
-FROM trips
-WHERE duration % 60 != 0 and duration < 1000;
-''', db)
-df.hist(bins=50)
-df = pd.read_sql_query('''
-SELECT duration
-FROM trips
-WHERE duration < 1000;
-''', db)
-df.hist(bins=50)
+counts, edges = duration_histogram(50, where='duration % 60 != 0 and duration < 1000')
+pd.Series(edges[:-1]).plot.hist(bins=edges, weights=counts)
+counts, edges = duration_histogram(50, where='duration < 1000')
+pd.Series(edges[:-1]).plot.hist(bins=edges, weights=counts)
 
 
 # In[ ]:
 
 
-df = pd.read_sql_query('''
+df = run_query('''
 SELECT bike_number as "Bike Number", COUNT(*) AS "Number of Trips", SUM(duration)/3600 as "Total Ridden Time (Hrs)"
 FROM trips
 GROUP BY bike_number
 ORDER BY COUNT(*) DESC
-''', db)
+''')
 df
 
 
 # In[ ]:
 
 
-df = pd.read_sql_query('''
+df = run_query('''
 SELECT bike_number as "Bike Number", COUNT(*) AS "Number of Trips", SUM(duration)/3600 as "Total Ridden Time (Hrs)"
 FROM trips
 GROUP BY bike_number
 ORDER BY COUNT(*) DESC
-''', db)
+''')
 df[:250].plot.bar(x='Bike Number',figsize=(12,5))
 
 
@@ -622,7 +599,7 @@ df[160:260].plot.bar(x='Bike Number',figsize=(12,5))
 # In[ ]:
 
 
-df = pd.read_sql_query('''
+df = run_query('''
 SELECT stations.station AS "Station", trips.sub_type , COUNT(*) AS "Count"
 FROM trips 
 INNER JOIN stations
@@ -630,7 +607,7 @@ ON trips.start_station = stations.id
 WHERE trips.start_station = trips.end_station
 GROUP BY stations.station, trips.sub_type
 ORDER BY COUNT(*) DESC;
-''', db)
+''')
 
 
 # In[ ]:
@@ -667,7 +644,7 @@ df2[:50].unstack().plot(kind='barh',figsize=(12,8))
 # In[ ]:
 
 
-df = pd.read_sql_query('''
+df = run_query('''
 SELECT start.municipality AS "Municipality", AVG(trips.duration) AS "Duration"
 FROM trips 
 INNER JOIN stations AS start
@@ -677,7 +654,7 @@ ON trips.end_station = end.id
 WHERE start.municipality = end.municipality
 GROUP BY start.municipality
 ORDER BY AVG(trips.duration) DESC;
-''', db)
+''')
 
 
 # In[ ]:
@@ -689,9 +666,9 @@ df
 # In[ ]:
 
 
-df = pd.read_sql_query('''
+df = run_query('''
 SELECT *
 FROM stations;
-''', db)
+''')
 df
 
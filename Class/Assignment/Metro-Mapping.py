@@ -549,15 +549,12 @@ m = folium.Map(location=[latitude,longitude], tiles='Stamen Terrain', zoom_start
 # In[ ]:
 
 
-# add the stations with color icons
-for index, row in metro_trimmed.iterrows():
-    tooltip_text = row.LINE + ' Line: ' + row.STATION
-    folium.Marker(
-        [row.LAT,row.LONG], 
-        popup=row.STATION, 
-        tooltip=tooltip_text,
-        icon=folium.Icon(color=row.color)
-    ).add_to(m)
+# add the stations with color icons, all in one layer (see map_layers.py);
+# clustering is off at every zoom, so each station keeps its own pin
+import map_layers
+map_layers.markers(metro_trimmed, lat='LAT', lng='LONG', popup='STATION',
+                   tooltip='{LINE} Line: {STATION}', color='color',
+                   disable_clustering_at_zoom=1).add_to(m)
 
 # show the map
 m
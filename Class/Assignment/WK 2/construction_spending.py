@@ -9,9 +9,14 @@ Then just place the files you downloaded alongside it.
 '''
 
 import os as _os
-import pickle as _pickle
+import threading as _threading
+import time as _time
 
-__all__ = ['get_spending']
+import corgis_loader as _corgis_loader
+
+__all__ = ['get_spending', 'iter_spending', 'get_column', 'summary', 'summaries',
+           'use_shared_dataset', 'create_shared_dataset',
+           'attach_shared_dataset', 'release_shared_dataset']
 
 def _tifa_definitions():
     return {"type": "ModuleType",
@@ -170,35 +175,558 @@ class _Constants(object):
     to hide stuff.
     '''
 
-class DatasetException(Exception):
-    ''' Thrown when there is an error loading the dataset for some reason.'''
-    
+# Thrown when there is an error loading the dataset for some reason.
+DatasetException = _corgis_loader.DatasetException
+
 _Constants._DATABASE_NAME = _os.path.join(_os.path.dirname(__file__),
                                           "construction_spending.data")
-if not _os.access(_Constants._DATABASE_NAME, _os.F_OK):
-    raise DatasetException(("Error! Could not find a \"{0}\" file. "
-                           "Make sure that there is a \"{0}\" in the "
-                           "same directory as \"{1}.py\"! Spelling is "
-                           "very important here."
-                           ).format(_Constants._DATABASE_NAME, __name__))
-elif not _os.access(_Constants._DATABASE_NAME, _os.R_OK):
-    raise DatasetException(("Error! Could not read the \"{0}\" file. "
-                            "Make sure that it readable by changing its "
-                            "permissions. You may need to get help from "
-                            "your instructor."
-                            ).format(_Constants._DATABASE_NAME, __name__))
+# Builds, caches and decodes the columns; shared with other CORGIS modules.
+_LOADER = _corgis_loader.Loader(_Constants._DATABASE_NAME, _tifa_definitions,
+                                "get_spending")
+
+def _check_database():
+    """
+    Makes sure that the data file is there and readable. This happens at
+    import time, unless the CORGIS_LAZY_IMPORT environment variable is set,
+    in which case it is put off until the data is first needed.
+    """
+    _LOADER.check()
 
+if not _os.environ.get("CORGIS_LAZY_IMPORT"):
+    _check_database()
+
+_Constants._SUMMARY_NAME = _os.path.join(_os.path.dirname(__file__),
+                                         "construction_spending.summary")
 
 _Constants._DATASET = None
+_Constants._DATASET_STAMP = None
+_Constants._COLUMNS = None
+_Constants._SHARED_NAME = None
+_Constants._SHARED = None
+_Constants._RELOADING = None
+_Constants._FAILED_STAMP = None
+# Held while the columns are loaded or a reload is started, so that threads
+# of a long-running service load them once.
+_Constants._LOCK = _threading.RLock()
+
+class _Columns(object):
+    '''
+    One version of the data file: the loader's columnar store (a float64
+    row of `values` per numeric leaf path such as
+    "annual.private.residential", and the string leaves as NumPy unicode
+    arrays) plus the time index, records and summaries built from it, so
+    that a reload replaces all of them at once.
+    '''
+    __slots__ = ('store', 'values', 'length', 'index', 'stamp', 'digest',
+                 'records', 'summaries')
+
+    def __init__(self, values, meta):
+        self.store = _LOADER.open_store(values, meta)
+        self.values = values
+        self.stamp = meta['stamp']
+        self.digest = meta.get('sha256')
+        self.records = None
+        self.summaries = None
+        self.length = self.store.length
+        self.index = _TimeIndex(self.store.column('time.year'),
+                                self.store.column('time.month'))
+
+_MONTH_NAMES = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def _ordinal(period):
+    """
+    Turns a period such as "Jan2002" or a (year, month) pair into a
+    month count that sorts the same way the periods do.
+    """
+    if isinstance(period, str):
+        try:
+            year, month = int(period[3:]), _MONTH_NAMES.index(period[:3]) + 1
+        except ValueError:
+            raise DatasetException(("Error! \"{0}\" is not a period like "
+                                    "\"Jan2002\".").format(period))
+    else:
+        year, month = period
+    return int(year) * 12 + int(month) - 1
+
+class _TimeIndex(object):
+    '''
+    Sorted views of the rows by period and by (month, period), so that
+    get_spending() can answer year, month and range filters with binary
+    searches instead of scanning every record.
+    '''
+    __slots__ = ('keys', 'rows', 'month_keys', 'month_rows', 'span')
+
+    def __init__(self, years, months):
+        ordinals = years.astype(_np.int64) * 12 + months.astype(_np.int64) - 1
+        self.rows = _np.argsort(ordinals, kind='stable')
+        self.keys = ordinals[self.rows]
+        self.span = int(self.keys[-1]) + 1 if len(self.keys) else 1
+        by_month = months.astype(_np.int64) * self.span + ordinals
+        self.month_rows = _np.argsort(by_month, kind='stable')
+        self.month_keys = by_month[self.month_rows]
+
+    def select(self, low, high, month=None):
+        """
+        Returns the rows whose period lies in [low, high], optionally only
+        those for one calendar month, in chronological order.
+        """
+        if month is None:
+            keys, rows = self.keys, self.rows
+        else:
+            low = max(low, 0)
+            high = min(high, self.span - 1)
+            if low > high:
+                return self.rows[:0]
+            low, high = month * self.span + low, month * self.span + high
+            keys, rows = self.month_keys, self.month_rows
+        return rows[_np.searchsorted(keys, low, 'left'):
+                    _np.searchsorted(keys, high, 'right')]
+
+def _record_leaves():
+    """
+    Returns the (path, type) pairs of one record of get_spending(), working
+    them out from the schema the first time they are needed.
+    """
+    return _LOADER.leaves
+
+_lookup = _corgis_loader.lookup
+
+def _stamp():
+    return _LOADER.stamp()
+
+def _pickle():
+    # pickle takes longer to import than everything else here put together,
+    # and only the first load of the data needs it.
+    import pickle
+    return pickle
+
+_np = None
+
+def _import_numpy():
+    """
+    Imports NumPy the first time the columnar store is needed, so that
+    importing this module stays cheap. Returns False if it is missing.
+    """
+    global _np
+    if _np is None:
+        try:
+            import numpy as _np
+        except ImportError:
+            _np = False
+    return _np is not False
+
+def _require_numpy():
+    if not _import_numpy():
+        raise DatasetException("The columnar store needs NumPy; "
+                               "install it with \"pip install numpy\".")
+
+# A shared segment starts with four int64s: a ready flag, the number of
+# columns, the number of records and the size of the pickled metadata. The
+# float64 matrix follows, then the metadata.
+_SHARED_HEADER = 4
+
+def _open_segment(name):
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 every process that merely attaches registers
+        # the segment with its resource tracker, which unlinks it when that
+        # process exits. Only the creator should own the segment.
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+def _publish_segment(name):
+    """
+    Creates the named segment and copies the columnar store into it.
+    Raises FileExistsError when another process got there first.
+    """
+    from multiprocessing import shared_memory
+    values, meta = _LOADER.read_columns()
+    blob = _pickle().dumps(meta, protocol=2)
+    offset = 8 * (_SHARED_HEADER + values.size)
+    segment = shared_memory.SharedMemory(name=name, create=True,
+                                         size=offset + len(blob))
+    header = _np.frombuffer(segment.buf, _np.int64, _SHARED_HEADER)
+    header[1:] = values.shape + (len(blob),)
+    _np.frombuffer(segment.buf, _np.float64, values.size,
+                   8 * _SHARED_HEADER)[:] = values.ravel()
+    segment.buf[offset:offset + len(blob)] = blob
+    header[0] = 1
+    del header
+    return segment
+
+def _segment_columns(segment, timeout=10.0):
+    """
+    Returns read-only, zero-copy values and the metadata of a published
+    segment, waiting for its creator to finish filling it if need be.
+    """
+    header = _np.frombuffer(segment.buf, _np.int64, _SHARED_HEADER)
+    deadline = _time.monotonic() + timeout
+    while not header[0]:
+        if _time.monotonic() > deadline:
+            raise DatasetException(("Error! The shared dataset \"{0}\" was "
+                                    "never finished by the process that "
+                                    "created it.").format(segment.name))
+        _time.sleep(0.001)
+    columns, records, size = (int(item) for item in header[1:])
+    del header
+    # frombuffer() keeps the segment's buffer exported for as long as the
+    # array lives, so the segment cannot be unmapped from under it.
+    values = _np.frombuffer(segment.buf, _np.float64, columns * records,
+                            8 * _SHARED_HEADER).reshape(columns, records)
+    values.flags.writeable = False
+    offset = 8 * (_SHARED_HEADER + values.size)
+    meta = _pickle().loads(bytes(segment.buf[offset:offset + size]))
+    return values, meta
+
+def _connect_segment(name, create):
+    """
+    Creates (create=True), attaches to (create=False) or, with create=None,
+    attaches to or else creates the named segment.
+    """
+    if create is not False:
+        try:
+            return _publish_segment(name)
+        except FileExistsError:
+            if create:
+                raise DatasetException(("Error! A shared dataset named "
+                                        "\"{0}\" already exists."
+                                        ).format(name))
+    try:
+        return _open_segment(name)
+    except FileNotFoundError:
+        raise DatasetException(("Error! There is no shared dataset named "
+                                "\"{0}\"; create it first."
+                                ).format(name))
 
-def get_spending():
+def _load_columns():
     """
-    Retrieves all of the spending.
+    Returns the columnar store, from the shared segment in shared mode and
+    from the files next to the data file otherwise.
     """
-    if _Constants._DATASET is None:
+    _require_numpy()
+    columns = _Constants._COLUMNS
+    if columns is not None:
+        _revalidate(columns.stamp)
+        return columns
+    with _Constants._LOCK:
+        columns = _Constants._COLUMNS
+        if columns is not None:
+            return columns
+        if _Constants._SHARED_NAME is None:
+            values, meta = _LOADER.read_columns()
+        else:
+            if _Constants._SHARED is None:
+                _Constants._SHARED = _connect_segment(
+                    _Constants._SHARED_NAME, None)
+            values, meta = _segment_columns(_Constants._SHARED)
+        _Constants._COLUMNS = columns = _Columns(values, meta)
+    return columns
+
+def _records(columns):
+    if columns.records is None:
+        columns.records = [_corgis_loader.Record(columns.store, row,
+                                                 columns.store.tree)
+                           for row in range(columns.length)]
+    return columns.records
+
+def _revalidate(stamp):
+    """
+    Starts reloading the data in the background when the data file no
+    longer matches the stamp of the loaded copy. This costs one os.stat()
+    and never waits for the reload: callers keep getting the old copy
+    until the new one is swapped in. Shared datasets are never reloaded.
+    """
+    if _Constants._RELOADING is not None or _Constants._SHARED_NAME is not None:
+        return
+    try:
+        current = _stamp()
+    except OSError:
+        # The file is being replaced right now; look again next time.
+        return
+    if current == stamp or current == _Constants._FAILED_STAMP:
+        return
+    with _Constants._LOCK:
+        if _Constants._RELOADING is not None:
+            return
+        _Constants._RELOADING = _threading.Thread(
+            target=_reload, args=(current,),
+            name="construction_spending reload")
+        _Constants._RELOADING.daemon = True
+        _Constants._RELOADING.start()
+
+def _reload(stamp):
+    """
+    Loads the changed data file and swaps the new copy in with a single
+    assignment. If it cannot be loaded (say it is still being written),
+    the old copy stays in use until the file changes again.
+    """
+    try:
+        if _import_numpy():
+            columns = _Columns(*_LOADER.read_columns())
+            _records(columns)
+            with _Constants._LOCK:
+                current = _Constants._COLUMNS
+                if current is not None and current.digest == columns.digest:
+                    current.stamp = columns.stamp
+                elif _Constants._SHARED_NAME is None:
+                    _Constants._COLUMNS = columns
+        else:
+            with open(_Constants._DATABASE_NAME, 'rb') as _:
+                dataset = _pickle().load(_)
+            _Constants._DATASET, _Constants._DATASET_STAMP = dataset, stamp
+    except Exception:
+        _Constants._FAILED_STAMP = stamp
+    finally:
+        with _Constants._LOCK:
+            _Constants._RELOADING = None
+
+def _switch_dataset(name, segment):
+    release_shared_dataset()
+    _Constants._SHARED_NAME = name
+    _Constants._SHARED = segment
+
+def get_spending(year=None, month=None, start=None, end=None, where=None):
+    """
+    Retrieves all of the spending, or only the records matching the given
+    calendar year, calendar month (1-12) and inclusive start/end periods
+    (written like "Jan2002" or as (year, month) pairs). where filters on
+    any other field, as in the modules corgis_loader generates: a dict from
+    a field such as "annual.private.residential" to a value or an
+    inclusive (low, high) range.
+    """
+    if where:
+        _corgis_loader.check_where(_record_leaves(), where)
+    if _import_numpy():
+        columns = _load_columns()
+        dataset = _records(columns)
+    elif _Constants._DATASET is None:
+        with _Constants._LOCK:
+            if _Constants._DATASET is None:
+                stamp = _stamp()
+                with open(_Constants._DATABASE_NAME, 'rb') as _:
+                    _Constants._DATASET = _pickle().load(_)
+                _Constants._DATASET_STAMP = stamp
+            dataset = _Constants._DATASET
+    else:
+        dataset = _Constants._DATASET
+        _revalidate(_Constants._DATASET_STAMP)
+    if year is None and month is None and start is None and end is None:
+        if not where:
+            return dataset
+        if not _import_numpy():
+            return [record for record in dataset
+                    if _corgis_loader.matches(record, where)]
+        return [dataset[row] for row in
+                _corgis_loader.select_rows(columns.store, where)]
+    low = float('-inf') if start is None else _ordinal(start)
+    high = float('inf') if end is None else _ordinal(end)
+    if year is not None:
+        low = max(low, _ordinal((year, 1)))
+        high = min(high, _ordinal((year, 12)))
+    if not _import_numpy():
+        return [record for record in dataset
+                if low <= _ordinal((record['time']['year'],
+                                    record['time']['month'])) <= high
+                and (month is None or record['time']['month'] == month)
+                and (not where or _corgis_loader.matches(record, where))]
+    rows = columns.index.select(low, high, month)
+    if where:
+        # Keeps the chronological order of the time index.
+        rows = rows[_np.isin(rows, _corgis_loader.select_rows(columns.store,
+                                                              where))]
+    return [dataset[row] for row in rows]
+
+def _build_summaries(columns):
+    """
+    Computes min/max/mean/sum/count for every numeric column at once.
+    """
+    values = columns.values
+    kinds = columns.store.kinds
+    count = values.shape[1]
+    aggregates = {'min': values.min(axis=1), 'max': values.max(axis=1),
+                  'sum': values.sum(axis=1)}
+    aggregates['mean'] = aggregates['sum'] / count
+    result = {}
+    for i, path in enumerate(columns.store.paths):
+        entry = dict((name, float(aggregate[i]))
+                     for name, aggregate in aggregates.items())
+        if kinds[i] != 'float':
+            for name in ('min', 'max', 'sum'):
+                entry[name] = int(entry[name])
+        entry['count'] = count
+        result[path] = entry
+    return result
+
+def _load_summaries():
+    """
+    Returns the aggregates, reading them from the summary file next to the
+    data file when it was computed from the current data, and recomputing
+    (and re-saving) them otherwise.
+    """
+    columns = _load_columns()
+    if columns.summaries is None:
+        try:
+            with open(_Constants._SUMMARY_NAME, 'rb') as _:
+                saved = _pickle().load(_)
+        except (OSError, EOFError, _pickle().UnpicklingError):
+            saved = None
+        if saved is not None and saved.get('sha256') == columns.digest:
+            summaries = saved['summaries']
+        else:
+            summaries = _build_summaries(columns)
+            temporary = "{0}.{1}.tmp".format(_Constants._SUMMARY_NAME,
+                                             _os.getpid())
+            try:
+                with open(temporary, 'wb') as _:
+                    _pickle().dump({'sha256': columns.digest,
+                                    'summaries': summaries}, _, protocol=2)
+                _os.replace(temporary, _Constants._SUMMARY_NAME)
+            except OSError:
+                pass
+        columns.summaries = summaries
+    return columns.summaries
+
+def iter_spending(fields=None, batch_size=None):
+    """
+    Iterates over the spending one record at a time without keeping the
+    dataset in memory, optionally keeping only some fields (such as
+    "time.period" or "annual.private"). The records are the same as those of
+    get_spending(). With a batch_size, yields NumPy structured arrays of up
+    to batch_size records instead, with one field per leaf path.
+    """
+    paths = _corgis_loader.select_leaves(_record_leaves(), fields)
+    if batch_size is None and not _import_numpy():
+        _check_database()
         with open(_Constants._DATABASE_NAME, 'rb') as _:
-            _Constants._DATASET = _pickle.load(_)
-    return _Constants._DATASET
+            dataset = _pickle().load(_)
+        for record in _corgis_loader.nest(paths, ([_lookup(record, path)
+                                                   for path in paths]
+                                                  for record in dataset)):
+            yield record
+        return
+    _require_numpy()
+    columns = _Constants._COLUMNS
+    if columns is not None:
+        _revalidate(columns.stamp)
+    elif _Constants._SHARED_NAME is None:
+        columns = _Columns(*_LOADER.read_columns())
+    else:
+        columns = _load_columns()
+    if batch_size is not None:
+        for batch in _corgis_loader.iter_batches(columns.store, paths,
+                                                 batch_size):
+            yield batch
+        return
+    for batch in _corgis_loader.iter_batches(columns.store, paths, 1024):
+        for record in _corgis_loader.nest(paths, batch.tolist()):
+            yield record
+
+def get_column(path):
+    """
+    Retrieves a single series, such as "annual.private.residential", as a
+    read-only NumPy array with one value per record. Numeric series are
+    zero-copy views of the memory-mapped columnar store.
+    """
+    columns = _load_columns()
+    store = columns.store
+    if path in store.positions or path in store.others:
+        return store.column(path)
+    raise DatasetException(("Error! There is no \"{0}\" column in "
+                            "\"{1}\"."
+                            ).format(path, _Constants._DATABASE_NAME))
+
+def summary(path):
+    """
+    Retrieves the precomputed min, max, mean, sum and count of one numeric
+    series, such as "annual.private.residential".
+    """
+    summaries = _load_summaries()
+    if path not in summaries:
+        raise DatasetException(("Error! There is no numeric \"{0}\" column "
+                                "in \"{1}\"."
+                                ).format(path, _Constants._DATABASE_NAME))
+    return dict(summaries[path])
+
+def summaries():
+    """
+    Retrieves the precomputed aggregates of every numeric series, keyed by
+    path.
+    """
+    return dict((path, dict(entry))
+                for path, entry in _load_summaries().items())
+
+def use_shared_dataset(name="construction_spending"):
+    """
+    Opts in to shared-memory mode: the first process to load the dataset
+    publishes it into the named shared memory segment, and every later one
+    attaches to it read-only instead of loading its own copy.
+    """
+    _switch_dataset(name, None)
+
+def create_shared_dataset(name="construction_spending"):
+    """
+    Publishes the dataset into a new shared memory segment and switches to
+    shared-memory mode. The caller owns the segment and should eventually
+    call release_shared_dataset(unlink=True).
+    """
+    _require_numpy()
+    _switch_dataset(name, _connect_segment(name, True))
+
+def attach_shared_dataset(name="construction_spending"):
+    """
+    Attaches read-only to a segment published by another process and
+    switches to shared-memory mode.
+    """
+    _require_numpy()
+    _switch_dataset(name, _connect_segment(name, False))
+
+def release_shared_dataset(unlink=False):
+    """
+    Leaves shared-memory mode, detaching from the segment and, with
+    unlink=True, destroying it for every process. Records and columns
+    obtained from the segment must no longer be in use.
+    """
+    segment = _Constants._SHARED
+    _Constants._SHARED_NAME = None
+    _Constants._SHARED = None
+    _Constants._COLUMNS = None
+    _Constants._DATASET = None
+    if segment is None:
+        return
+    # Detach before unlinking, so that a segment still in use is left as it
+    # was and release_shared_dataset() can simply be called again.
+    try:
+        try:
+            segment.close()
+        except BufferError:
+            # Records and their snapshot refer to each other, so dropping
+            # the snapshot only frees them once the cycle is collected.
+            import gc
+            gc.collect()
+            segment.close()
+    except BufferError:
+        _Constants._SHARED_NAME = segment.name
+        _Constants._SHARED = segment
+        raise DatasetException(("Error! The shared dataset \"{0}\" is still "
+                                "in use by records or columns retrieved from "
+                                "it.").format(segment.name))
+    if unlink:
+        registered = _os.name == "posix" and getattr(segment, "_track", True)
+        from multiprocessing import resource_tracker
+        if registered:
+            # Attaching processes may have unregistered the segment (see
+            # _open_segment); unlink() expects the tracker to know it.
+            resource_tracker.register(segment._name, "shared_memory")
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            # Already unlinked, by its creator or another process.
+            if registered:
+                resource_tracker.unregister(segment._name, "shared_memory")
 
 if __name__ == '__main__':
     from pprint import pprint as _pprint
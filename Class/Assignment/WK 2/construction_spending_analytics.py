@@ -0,0 +1,127 @@
+'''
+Time-series analytics over every construction spending series at once.
+
+All 114 series (annual/current x combined/private/public x 19 categories)
+are laid out as one 2-D array with a row per month, in chronological order,
+and a column per series, so that growth, rolling windows, seasonality and
+sector shares each take a handful of array operations:
+
+    import construction_spending_analytics as analytics
+    periods, paths, data = analytics.load()
+    growth = analytics.yoy_growth(data)
+    growth[:, paths.index('annual.private.residential')]
+
+Months without enough history (the first year for year-over-year growth,
+the first window - 1 months for rolling windows) are NaN, as are growth
+rates and shares whose denominator is zero.
+'''
+
+import numpy as np
+
+import construction_spending
+
+MEASURES = ('annual', 'current')
+SECTORS = ('combined', 'private', 'public')
+
+
+def categories():
+    """
+    Returns the 19 spending categories, in schema order.
+    """
+    prefix = 'annual.combined.'
+    return [path[len(prefix):]
+            for path, _ in construction_spending._record_leaves()
+            if path.startswith(prefix)]
+
+
+def series_paths(measures=MEASURES, sectors=SECTORS):
+    """
+    Returns the paths of the requested series, measure by measure, then
+    sector by sector, then category by category.
+    """
+    return ['{0}.{1}.{2}'.format(measure, sector, category)
+            for measure in measures for sector in sectors
+            for category in categories()]
+
+
+def load(paths=None):
+    """
+    Returns (periods, paths, data): the period names of the rows, the paths
+    of the columns (every series by default) and the (time x series)
+    float64 array itself.
+    """
+    paths = series_paths() if paths is None else list(paths)
+    order = np.argsort(construction_spending.get_column('time.index'),
+                       kind='stable')
+    periods = construction_spending.get_column('time.period')[order]
+    data = np.column_stack([construction_spending.get_column(path)
+                            for path in paths])[order]
+    return periods.tolist(), paths, data
+
+
+def _divide(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = numerator / denominator
+    result[~np.isfinite(result)] = np.nan
+    return result
+
+
+def yoy_growth(data, periods_per_year=12):
+    """
+    Returns the growth of every series over the same month a year earlier,
+    as a fraction (0.05 is 5%).
+    """
+    growth = np.full(data.shape, np.nan)
+    growth[periods_per_year:] = _divide(data[periods_per_year:]
+                                        - data[:-periods_per_year],
+                                        data[:-periods_per_year])
+    return growth
+
+
+def rolling_sum(data, window):
+    """
+    Returns the sum of every series over the trailing window of months.
+    """
+    totals = np.cumsum(data, axis=0)
+    result = np.full(data.shape, np.nan)
+    result[window - 1:] = totals[window - 1:]
+    result[window:] -= totals[:-window]
+    return result
+
+
+def rolling_mean(data, window):
+    """
+    Returns the mean of every series over the trailing window of months.
+    """
+    return rolling_sum(data, window) / window
+
+
+def seasonal_indices(data, months=None):
+    """
+    Returns a (12 x series) array: the mean of each calendar month divided
+    by the overall mean of the series, so 1.1 means 10% above average.
+    `months` holds the calendar month (1-12) of each row and defaults to
+    the dataset's own.
+    """
+    if months is None:
+        order = np.argsort(construction_spending.get_column('time.index'),
+                           kind='stable')
+        months = construction_spending.get_column('time.month')[order]
+    months = np.asarray(months, dtype=np.intp) - 1
+    membership = np.zeros((12, len(months)))
+    membership[months, np.arange(len(months))] = 1
+    monthly = _divide(membership @ data, membership.sum(axis=1)[:, None])
+    return _divide(monthly, data.mean(axis=0))
+
+
+def sector_shares(measure='annual'):
+    """
+    Returns (paths, shares): the private and public series of the measure
+    and, for every month, their share of the combined spending of the same
+    category.
+    """
+    combined = series_paths((measure,), ('combined',))
+    parts = series_paths((measure,), ('private', 'public'))
+    _, _, data = load(combined + parts)
+    totals = data[:, :len(combined)]
+    return parts, _divide(data[:, len(combined):], np.tile(totals, 2))
@@ -0,0 +1,332 @@
+'''
+Benchmarks for the construction_spending loader. Run it from anywhere:
+
+    python construction_spending_bench.py import --repeat 20 --budget 5
+    python construction_spending_bench.py all --json results.json
+
+Every measurement runs in fresh interpreters against a copy of the module
+in a temporary directory, so the sidecar files next to the real data file
+are never touched:
+
+* import   cold import time, failing (exit status 1) over --budget ms
+* cold     first load (building the columns), later cold loads (memory
+           mapping them) and the old pickle load, with peak RSS for each
+           (null where it can't be measured: on Windows without psutil)
+* warm     cached get_spending(), filtered get_spending(), get_column()
+           and summary() calls
+* fields   latency of reading every leaf path through the records
+* scaling  cold loads of synthetic datasets --scales times larger
+
+"all" runs everything; --json writes the machine-readable results to a file
+(or to standard output with "-").
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import pickle
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODULE = "construction_spending"
+DATA = MODULE + ".data"
+# The module and the loader it is built on.
+SOURCES = (MODULE + ".py", "corgis_loader.py")
+SERIES = "annual.private.residential"
+
+# Runs inside a fresh interpreter in the workspace; the mode comes from
+# argv and the results go to stdout as JSON.
+_CHILD = '''
+import json, sys, time
+mode, repeat, series = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+
+def peak_rss():
+    # resource is POSIX-only; Windows reports the peak working set through
+    # psutil, and without it the peak is unknown (null).
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def mean_us(call):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+result = {}
+start = time.perf_counter()
+if mode == "pickle":
+    import pickle
+    with open("construction_spending.data", "rb") as data:
+        records = pickle.load(data)
+    result["load_s"] = time.perf_counter() - start
+    result["records"] = len(records)
+else:
+    import construction_spending as module
+    result["import_s"] = time.perf_counter() - start
+    records = module.get_spending()
+    result["load_s"] = time.perf_counter() - start
+    result["records"] = len(records)
+    column = module.get_column(series)
+    column.sum()
+    result["first_column_s"] = time.perf_counter() - start
+    if mode == "warm":
+        year = records[len(records) // 2]["time"]["year"]
+        result["get_spending_us"] = mean_us(module.get_spending)
+        result["get_spending_year_us"] = mean_us(
+            lambda: module.get_spending(year=year))
+        result["get_spending_range_us"] = mean_us(
+            lambda: module.get_spending(start=(year, 3), end=(year + 1, 2)))
+        result["get_column_us"] = mean_us(lambda: module.get_column(series))
+        result["column_sum_us"] = mean_us(
+            lambda: module.get_column(series).sum())
+        module.summary(series)
+        result["summary_us"] = mean_us(lambda: module.summary(series))
+    elif mode == "fields":
+        latencies = {}
+        for path, _ in module._record_leaves():
+            keys = path.split(".")
+            def read():
+                for record in records:
+                    value = record
+                    for key in keys:
+                        value = value[key]
+            latencies[path] = mean_us(read) * 1000 / len(records)
+        result["access_ns"] = latencies
+result["peak_rss"] = peak_rss()
+print(json.dumps(result))
+'''
+
+
+def _synthesize(source, target, scale):
+    """
+    Writes a data file holding scale copies of the records, each copy moved
+    on in time so that periods stay unique. The pickle is written one chunk
+    of records at a time, so even 1000x copies never sit in memory at once.
+    """
+    with open(source, "rb") as data:
+        records = pickle.load(data)
+    years = (max(record["time"]["year"] for record in records)
+             - min(record["time"]["year"] for record in records) + 1)
+    with open(target, "wb") as output:
+        output.write(pickle.PROTO + bytes([2]) + pickle.EMPTY_LIST)
+        for copy in range(scale):
+            chunk = []
+            for record in records:
+                time = dict(record["time"])
+                time["index"] += copy * len(records)
+                time["year"] += copy * years
+                time["period"] = time["month name"] + str(time["year"])
+                chunk.append(dict(
+                    (key, time if key == "time" else
+                     dict((sector, dict(values))
+                          for sector, values in value.items()))
+                    for key, value in record.items()))
+            # Each item is pickled on its own, so memo entries never need
+            # to refer across items.
+            output.write(pickle.MARK)
+            for item in chunk:
+                output.write(pickle.dumps(item, 2)[2:-1])
+            output.write(pickle.APPENDS)
+        output.write(pickle.STOP)
+
+
+@contextlib.contextmanager
+def _workspace(scale=1):
+    """
+    Yields a temporary directory holding the module and a data file scale
+    times as large as the real one.
+    """
+    directory = tempfile.mkdtemp(prefix="construction_spending_bench_")
+    try:
+        for name in SOURCES:
+            shutil.copy(os.path.join(HERE, name), directory)
+        if scale == 1:
+            shutil.copy(os.path.join(HERE, DATA), directory)
+        else:
+            _synthesize(os.path.join(HERE, DATA),
+                        os.path.join(directory, DATA), scale)
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _child(directory, mode, repeat=1):
+    env = dict(os.environ)
+    env.pop("CORGIS_LAZY_IMPORT", None)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    result = subprocess.run([sys.executable, "-c", _CHILD, mode, str(repeat),
+                             SERIES],
+                            cwd=directory, env=env, stdout=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    return json.loads(result.stdout)
+
+
+def _median(runs):
+    """
+    Folds a list of child results into the (low) median of every number,
+    or None for a number some run could not measure.
+    """
+    return dict((key, None if any(run[key] is None for run in runs)
+                 else statistics.median_low(run[key] for run in runs))
+                for key in runs[0])
+
+
+def _peak(result):
+    if result["peak_rss"] is None:
+        return "peak unknown"
+    return "{0:.1f} MB peak".format(result["peak_rss"] / 2 ** 20)
+
+
+def _import_time(directory, env):
+    """
+    Imports the module in directory once in a fresh interpreter and returns
+    how long the import took in milliseconds, as reported by -X importtime.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                             "import " + MODULE],
+                            cwd=directory, env=env, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    for line in reversed(result.stderr.splitlines()):
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == MODULE:
+            return int(fields[1]) / 1000.0
+    raise RuntimeError("No import time reported for " + MODULE)
+
+
+def bench_import(repeat=20):
+    """
+    Returns the min, median and max cold import time in milliseconds, with
+    the workspace copy's bytecode cache written by a first import (the
+    real module's __pycache__ is neither used nor written).
+    """
+    env = dict(os.environ, CORGIS_LAZY_IMPORT="1")
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    with _workspace() as directory:
+        _import_time(directory, env)
+        times = [_import_time(directory, env) for _ in range(repeat)]
+    return {"min": min(times), "median": statistics.median(times),
+            "max": max(times)}
+
+
+def bench_cold(repeat=5, scale=1):
+    """
+    Returns the first load (which builds the columnar files), the median of
+    later cold loads, and the median of plain pickle loads for comparison.
+    """
+    with _workspace(scale) as directory:
+        build = _child(directory, "load")
+        load = _median([_child(directory, "load") for _ in range(repeat)])
+        baseline = _median([_child(directory, "pickle")
+                            for _ in range(repeat)])
+    return {"scale": scale, "records": load["records"], "build": build,
+            "load": load, "pickle": baseline}
+
+
+def bench_warm(repeat=1000):
+    """
+    Returns the mean latency, in microseconds, of cached calls.
+    """
+    with _workspace() as directory:
+        _child(directory, "load")
+        return _child(directory, "warm", repeat)
+
+
+def bench_fields(repeat=20):
+    """
+    Returns the mean latency, in nanoseconds, of reading each leaf path of
+    a record, plus the fastest, median and slowest of them.
+    """
+    with _workspace() as directory:
+        _child(directory, "load")
+        result = _child(directory, "fields", repeat)
+    latencies = result["access_ns"]
+    result.update({"min_ns": min(latencies.values()),
+                   "median_ns": statistics.median(latencies.values()),
+                   "max_ns": max(latencies.values())})
+    return result
+
+
+def bench_scaling(scales=(10, 100, 1000), repeat=3):
+    return [bench_cold(repeat, scale) for scale in scales]
+
+
+def _print_cold(result):
+    print("{0}x ({1} records): build {2:.3f} s, load {3:.3f} s ({4}), "
+          "pickle {5:.3f} s ({6})".format(
+              result["scale"], result["records"], result["build"]["load_s"],
+              result["load"]["load_s"], _peak(result["load"]),
+              result["pickle"]["load_s"], _peak(result["pickle"])),
+          file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the construction_spending loader.")
+    parser.add_argument("command", choices=["import", "cold", "warm",
+                                            "fields", "scaling", "all"])
+    parser.add_argument("--repeat", type=int, default=None,
+                        help="repetitions per measurement")
+    parser.add_argument("--budget", type=float, default=5.0,
+                        help="maximum median import time in milliseconds")
+    parser.add_argument("--scales", type=int, nargs="+",
+                        default=[10, 100, 1000])
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+    commands = (["import", "cold", "warm", "fields", "scaling"]
+                if args.command == "all" else [args.command])
+    results = {"python": platform.python_version(),
+               "platform": platform.platform()}
+    status = 0
+    for command in commands:
+        if command == "import":
+            result = bench_import(args.repeat or 20)
+            print("import: min {min:.2f} ms, median {median:.2f} ms, "
+                  "max {max:.2f} ms".format(**result), file=sys.stderr)
+            if result["median"] > args.budget:
+                status = 1
+        elif command == "cold":
+            result = bench_cold(args.repeat or 5)
+            _print_cold(result)
+        elif command == "warm":
+            result = bench_warm(args.repeat or 1000)
+            for key in sorted(result):
+                if key.endswith("_us"):
+                    print("warm {0}: {1:.2f} us".format(key[:-3],
+                                                        result[key]),
+                          file=sys.stderr)
+        elif command == "fields":
+            result = bench_fields(args.repeat or 20)
+            print("fields: min {min_ns:.0f} ns, median {median_ns:.0f} ns, "
+                  "max {max_ns:.0f} ns per access".format(**result),
+                  file=sys.stderr)
+        else:
+            result = bench_scaling(args.scales, args.repeat or 3)
+            for scale in result:
+                _print_cold(scale)
+        results[command] = result
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    elif args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=1)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+'''
+Converts construction_spending.data into flat, typed tables: a Parquet or
+Arrow IPC file plus a CSV, with columns named like the CSVs shipped with
+the later weeks ("time.period", "annual.private.residential", ...).
+
+    python construction_spending_convert.py OUTPUT_DIR --format parquet
+
+The column list and types come from the module's _tifa_definitions()
+schema. construction_spending.manifest.json records the SHA-256 of the
+data file every output file was written from, and a file is only
+rewritten when that differs from the data file's, so the command is cheap
+to run before every notebook session. Afterwards,
+pd.read_parquet('construction_spending.parquet') (or pd.read_feather for
+the Arrow file) replaces pd.read_csv('construction_spending.csv').
+'''
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import pickle
+import sys
+
+import construction_spending
+
+FORMATS = {"parquet": "construction_spending.parquet",
+           "arrow": "construction_spending.arrow"}
+CSV_NAME = "construction_spending.csv"
+MANIFEST_NAME = "construction_spending.manifest.json"
+
+
+def flatten(dataset):
+    """
+    Returns the leaf paths, the column of values for each path and its type:
+    "int" or "float" for NumType leaves depending on the values, "str" for
+    StrType leaves.
+    """
+    paths, columns, types = [], {}, {}
+    for path, kind in construction_spending._record_leaves():
+        values = [construction_spending._lookup(record, path)
+                  for record in dataset]
+        if kind == "StrType":
+            types[path] = "str"
+        elif all(isinstance(value, int) for value in values):
+            types[path] = "int"
+        else:
+            types[path] = "float"
+        paths.append(path)
+        columns[path] = values
+    return paths, columns, types
+
+
+def _write_arrow(paths, columns, types, filename, fmt):
+    try:
+        import pyarrow
+    except ImportError:
+        raise RuntimeError("Writing {0} files needs pyarrow; install it with "
+                           "\"pip install pyarrow\".".format(fmt))
+    arrow_types = {"int": pyarrow.int64(), "float": pyarrow.float64(),
+                   "str": pyarrow.string()}
+    table = pyarrow.table([pyarrow.array(columns[path], arrow_types[types[path]])
+                           for path in paths], names=paths)
+    if fmt == "parquet":
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, filename)
+    else:
+        import pyarrow.feather
+        pyarrow.feather.write_feather(table, filename, compression="lz4")
+
+
+def _write_csv(paths, columns, filename):
+    with open(filename, "w", newline="") as output:
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(paths)
+        writer.writerows(zip(*(columns[path] for path in paths)))
+
+
+def _replace(filename, write):
+    """
+    Writes through a temporary file so readers never see a partial file.
+    """
+    temporary = "{0}.{1}.tmp".format(filename, os.getpid())
+    try:
+        write(temporary)
+        os.replace(temporary, filename)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def convert(output_dir, fmt="parquet", force=False):
+    """
+    Writes the typed file and the CSV into output_dir unless they are
+    already up to date with the data file. Returns the paths written.
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format {0!r}; expected one of {1}."
+                         .format(fmt, ", ".join(sorted(FORMATS))))
+    with open(construction_spending._Constants._DATABASE_NAME, "rb") as source:
+        data = source.read()
+    digest = hashlib.sha256(data).hexdigest()
+    targets = [os.path.join(output_dir, FORMATS[fmt]),
+               os.path.join(output_dir, CSV_NAME)]
+    manifest_name = os.path.join(output_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_name) as manifest:
+            recorded = json.load(manifest)
+    except (OSError, ValueError):
+        recorded = {}
+    files = recorded.get("files")
+    if not isinstance(files, dict):
+        # Written before the manifest recorded a digest per file.
+        files = {}
+    if not force and all(files.get(os.path.basename(target)) == digest
+                         and os.path.exists(target) for target in targets):
+        return []
+    paths, columns, types = flatten(pickle.loads(data))
+    os.makedirs(output_dir, exist_ok=True)
+    _replace(targets[0],
+             lambda name: _write_arrow(paths, columns, types, name, fmt))
+    _replace(targets[1], lambda name: _write_csv(paths, columns, name))
+    # Files of the other format keep the digest they were written from.
+    files.update((os.path.basename(target), digest) for target in targets)
+    manifest = {"sha256": digest, "rows": len(columns[paths[0]]),
+                "columns": dict((path, types[path]) for path in paths),
+                "files": files}
+
+    def write_manifest(name):
+        with open(name, "w") as output:
+            json.dump(manifest, output, indent=1)
+    _replace(manifest_name, write_manifest)
+    return targets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert construction_spending.data to typed files.")
+    parser.add_argument("output_dir", nargs="?", default=".")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+    parser.add_argument("--force", action="store_true",
+                        help="rewrite even if the data file has not changed")
+    args = parser.parse_args(argv)
+    written = convert(args.output_dir, args.format, args.force)
+    for target in written:
+        print("wrote", target)
+    if not written:
+        print("up to date")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,723 @@
+'''
+Fast loader shared by CORGIS dataset modules, and a generator for them.
+
+A CORGIS module (construction_spending.py, classics.py, ...) describes its
+records with a _tifa_definitions() schema and unpickles its whole .data
+file into nested dictionaries on first use. A Loader compiles that schema
+into a list of leaf paths ("time.year", "annual.private.residential") and
+instead keeps:
+
+* one contiguous, memory-mapped float64 column per numeric leaf, cached
+  next to the data file and rebuilt when the data file changes,
+* lazy, read-only record mappings that decode values only when indexed,
+* projection (only some fields) and batched iteration,
+* filters on any leaf, answered from lazily built sorted indexes.
+
+construction_spending.py is built on the same pieces (Loader.read_columns,
+Store, Record, nest, select_leaves, iter_batches), adding its own time
+index, summaries and shared-memory mode on top.
+
+To give a downloaded CORGIS module the fast path, generate a replacement
+that keeps its public getter and schema:
+
+    python corgis_loader.py classics.py --output fast/
+
+The generated module needs this file next to it, like its .data file.
+'''
+
+import os
+import sys
+import threading
+from collections.abc import Mapping
+
+
+class DatasetException(Exception):
+    ''' Thrown when there is an error loading the dataset for some reason.'''
+
+
+def _pickle():
+    import pickle
+    return pickle
+
+
+def _numpy():
+    """
+    Returns NumPy, or None when it is not installed; the loaders then fall
+    back to the plain pickled records.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _leaves(definition, prefix=()):
+    if definition["type"] == "DictType" and "literals" in definition:
+        for literal, value in zip(definition["literals"],
+                                  definition["values"]):
+            for leaf in _leaves(value, prefix + (literal["value"],)):
+                yield leaf
+    else:
+        yield ".".join(prefix), definition["type"]
+
+
+def compile_schema(definitions, function):
+    """
+    Returns the (path, type) pairs of one record returned by the named
+    getter of a _tifa_definitions() schema, in schema order.
+    """
+    returns = definitions["fields"][function]["returns"]
+    if returns["type"] != "ListType" or returns["subtype"]["type"] != "DictType":
+        raise DatasetException("Error! \"{0}\" does not return a list of "
+                               "records.".format(function))
+    return list(_leaves(returns["subtype"]))
+
+
+def record_getters(definitions):
+    """
+    Returns the names of the functions of a schema that return records.
+    """
+    return [name for name, field in definitions["fields"].items()
+            if field["type"] == "FunctionType"
+            and field["returns"]["type"] == "ListType"
+            and field["returns"]["subtype"]["type"] == "DictType"]
+
+
+def lookup(record, path):
+    """
+    Returns the value at a leaf path such as "time.year" of a nested record.
+    """
+    for key in path.split("."):
+        record = record[key]
+    return record
+
+
+# The Python types a where condition must have for each kind of leaf.
+_CONDITION_TYPES = {"NumType": (int, float), "BoolType": (int, float),
+                    "StrType": (str,)}
+
+
+def check_where(leaves, where):
+    """
+    Makes sure that every field of where is a leaf, raising DatasetException
+    otherwise, and that its condition (a value or an inclusive (low, high)
+    range) can be compared with the leaf's values, raising TypeError for,
+    say, a string against a numeric leaf.
+    """
+    kinds = dict(leaves)
+    for path, condition in where.items():
+        if path not in kinds:
+            raise DatasetException("Error! There is no \"{0}\" field."
+                                   .format(path))
+        expected = _CONDITION_TYPES.get(kinds[path])
+        bounds = condition if isinstance(condition, tuple) else (condition,)
+        if expected and not all(isinstance(bound, expected)
+                                for bound in bounds):
+            raise TypeError("\"{0}\" holds {1} values and cannot be compared "
+                            "with {2!r}.".format(path, kinds[path], condition))
+
+
+def matches(record, where):
+    """
+    Tells whether a record satisfies every condition of where.
+    """
+    return all(_within(lookup(record, path), condition)
+               for path, condition in where.items())
+
+
+class Store(object):
+    '''
+    The columns of one data file. Numeric leaves live in `values`, one row
+    per leaf; every other leaf is a NumPy array in `others` (unicode for
+    StrType, object dtype for anything else).
+    '''
+    __slots__ = ('values', 'paths', 'positions', 'kinds', 'others', 'length',
+                 'tree', 'indexes')
+
+    def __init__(self, np, leaves, values, meta):
+        self.values = values
+        self.paths = meta['paths']
+        self.positions = dict((path, i) for i, path in enumerate(self.paths))
+        self.kinds = meta['kinds']
+        self.others = {}
+        for path, items in meta['others'].items():
+            if all(isinstance(item, str) for item in items):
+                column = np.array(items, dtype=str)
+            else:
+                column = np.empty(len(items), dtype=object)
+                column[:] = items
+            column.flags.writeable = False
+            self.others[path] = column
+        self.length = meta['length']
+        self.tree = {}
+        for path, _ in leaves:
+            *parents, key = path.split(".")
+            node = self.tree
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[key] = path
+        self.indexes = {}
+
+    def column(self, path):
+        if path in self.positions:
+            return self.values[self.positions[path]]
+        return self.others[path]
+
+    def rows(self, path, condition):
+        """
+        Returns the sorted rows whose leaf equals condition, or lies in the
+        inclusive (low, high) range it gives.
+        """
+        np = _numpy()
+        column = self.column(path)
+        if column.dtype == object:
+            return np.array([row for row, item in enumerate(column.tolist())
+                             if _within(item, condition)], dtype=np.intp)
+        if isinstance(condition, tuple):
+            low, high = condition
+        else:
+            low = high = condition
+        if path not in self.indexes:
+            order = np.argsort(column, kind='stable')
+            self.indexes[path] = (column[order], order)
+        keys, order = self.indexes[path]
+        return np.sort(order[np.searchsorted(keys, low, 'left'):
+                             np.searchsorted(keys, high, 'right')])
+
+    def decode(self, path, row):
+        if path in self.others:
+            value = self.others[path][row]
+            return str(value) if isinstance(value, str) else value
+        position = self.positions[path]
+        value = float(self.values[position, row])
+        kind = self.kinds[position]
+        if kind == 'int':
+            return int(value)
+        if kind == 'bool':
+            return bool(value)
+        return value
+
+
+class Record(Mapping):
+    '''
+    Read-only stand-in for one nested record dictionary. It only remembers
+    its row and where it sits in the schema; values are decoded from the
+    columns when they are looked up.
+    '''
+    __slots__ = ('_store', '_row', '_tree')
+
+    def __init__(self, store, row, tree):
+        self._store = store
+        self._row = row
+        self._tree = tree
+
+    def __getitem__(self, key):
+        child = self._tree[key]
+        if isinstance(child, dict):
+            return Record(self._store, self._row, child)
+        return self._store.decode(child, self._row)
+
+    def __iter__(self):
+        return iter(self._tree)
+
+    def __len__(self):
+        return len(self._tree)
+
+    def keys(self):
+        return self._tree.keys()
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        # Copies and pickles come out as the plain dictionaries they mimic.
+        return (dict, (), None, None, iter(self.items()))
+
+
+def nest(paths, rows):
+    """
+    Turns flat rows of leaf values into nested dictionaries, one per row.
+    """
+    keys = [path.split(".") for path in paths]
+    for row in rows:
+        record = {}
+        for parts, value in zip(keys, row):
+            node = record
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = value
+        yield record
+
+
+def _is_number(value):
+    return isinstance(value, (int, float))
+
+
+def _within(item, condition):
+    """
+    Tells whether item equals condition or, for a (low, high) tuple, lies
+    in that inclusive range; values that cannot be ordered never match.
+    """
+    if not isinstance(condition, tuple):
+        return item == condition
+    low, high = condition
+    try:
+        return low <= item <= high
+    except TypeError:
+        return False
+
+
+class Loader(object):
+    '''
+    Loads the records of one CORGIS data file through a columnar cache.
+
+    `definitions` is the module's _tifa_definitions function and `function`
+    the name of its record getter, e.g. "get_book".
+    '''
+
+    def __init__(self, data_path, definitions, function):
+        self.data_path = data_path
+        self.definitions = definitions
+        self.function = function
+        base = os.path.splitext(data_path)[0]
+        self.columns_path = base + ".corgis.npy"
+        self.meta_path = base + ".corgis.meta"
+        # Where construction_spending kept its columns before it was built
+        # on this loader; removed when the columns are first read.
+        self._legacy_paths = [base + ".columns.npy", base + ".columns.meta"]
+        self._leaves = None
+        self._store = None
+        self._records = None
+        self._checked = False
+        # Serializes building, writing and opening the columns.
+        self._lock = threading.RLock()
+
+    @property
+    def leaves(self):
+        if self._leaves is None:
+            self._leaves = compile_schema(self.definitions(), self.function)
+        return self._leaves
+
+    def check(self):
+        """
+        Makes sure that the data file is there and readable.
+        """
+        if self._checked:
+            return
+        module = os.path.splitext(os.path.basename(self.data_path))[0]
+        if not os.access(self.data_path, os.F_OK):
+            raise DatasetException(("Error! Could not find a \"{0}\" file. "
+                                    "Make sure that there is a \"{0}\" in the "
+                                    "same directory as \"{1}.py\"! Spelling "
+                                    "is very important here."
+                                    ).format(self.data_path, module))
+        elif not os.access(self.data_path, os.R_OK):
+            raise DatasetException(("Error! Could not read the \"{0}\" file. "
+                                    "Make sure that it readable by changing "
+                                    "its permissions. You may need to get "
+                                    "help from your instructor."
+                                    ).format(self.data_path))
+        self._checked = True
+
+    def stamp(self):
+        """
+        Returns the (size, modification time) the cached columns are checked
+        against.
+        """
+        self.check()
+        stat = os.stat(self.data_path)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def unpickle(self):
+        """
+        Returns the records as stored in the data file.
+        """
+        self.check()
+        with open(self.data_path, 'rb') as _:
+            return _pickle().load(_)
+
+    def _build(self, np, dataset, stamp, digest):
+        """
+        Splits the records into numeric columns, typed by their values, and
+        everything else.
+        """
+        paths, kinds, rows, others = [], [], [], {}
+        for path, kind in self.leaves:
+            items = [lookup(record, path) for record in dataset]
+            if kind in ("NumType", "BoolType") and all(map(_is_number, items)):
+                paths.append(path)
+                if all(isinstance(item, bool) for item in items):
+                    kinds.append('bool')
+                elif all(isinstance(item, int) for item in items):
+                    kinds.append('int')
+                else:
+                    kinds.append('float')
+                rows.append(items)
+            else:
+                others[path] = items
+        values = np.array(rows, dtype=np.float64).reshape(len(paths),
+                                                          len(dataset))
+        meta = {'stamp': stamp, 'sha256': digest, 'paths': paths,
+                'kinds': kinds, 'others': others, 'length': len(dataset)}
+        return values, meta
+
+    def _write(self, np, values, meta):
+        """
+        Stores the columns next to the data file, or only their metadata when
+        values is None. Both files are written to a temporary file of their
+        own first so that a concurrent reader or writer (in this process or
+        another) never sees half of one.
+        """
+        import tempfile
+        files = [(self.meta_path,
+                  lambda _: _pickle().dump(meta, _, protocol=2))]
+        if values is not None:
+            files.insert(0, (self.columns_path, lambda _: np.save(_, values)))
+        for name, write in files:
+            handle, temporary = tempfile.mkstemp(
+                prefix=os.path.basename(name) + ".", suffix=".tmp",
+                dir=os.path.dirname(name) or ".")
+            try:
+                with os.fdopen(handle, 'wb') as _:
+                    write(_)
+                os.replace(temporary, name)
+            except BaseException:
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+                raise
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path, 'rb') as _:
+                return _pickle().load(_)
+        except (OSError, EOFError, _pickle().UnpicklingError):
+            return None
+
+    def read_columns(self):
+        """
+        Returns the values and metadata of the columnar cache, memory-mapping
+        them from disk when they are up to date and (re)building them from
+        the data file when they are not.
+        """
+        np = _numpy()
+        if np is None:
+            raise DatasetException("The columnar store needs NumPy; install "
+                                   "it with \"pip install numpy\".")
+        with self._lock:
+            self._remove_legacy()
+            return self._read_columns(np)
+
+    def _remove_legacy(self):
+        for name in self._legacy_paths:
+            try:
+                os.remove(name)
+            except OSError:
+                # Already gone, or not ours to remove (a read-only install).
+                pass
+        self._legacy_paths = []
+
+    def _read_columns(self, np):
+        stamp = self.stamp()
+        meta = self._read_meta()
+        if meta is not None and meta.get('stamp') == stamp:
+            try:
+                return np.load(self.columns_path, mmap_mode='r'), meta
+            except (OSError, ValueError):
+                pass
+        with open(self.data_path, 'rb') as _:
+            data = _.read()
+        import hashlib
+        digest = hashlib.sha256(data).hexdigest()
+        if meta is not None and meta.get('sha256') == digest:
+            # Touched or copied over, but the same data: keep the columns.
+            try:
+                values = np.load(self.columns_path, mmap_mode='r')
+                meta['stamp'] = stamp
+                try:
+                    self._write(np, None, meta)
+                except OSError:
+                    pass
+                return values, meta
+            except (OSError, ValueError):
+                pass
+        values, meta = self._build(np, _pickle().loads(data), stamp, digest)
+        try:
+            self._write(np, values, meta)
+            values = np.load(self.columns_path, mmap_mode='r')
+        except OSError:
+            # Read-only install: keep the freshly built copy in memory.
+            values.flags.writeable = False
+        return values, meta
+
+    def open_store(self, values, meta):
+        """
+        Returns a Store over columns from read_columns() (or a copy of
+        them, such as one in shared memory).
+        """
+        return Store(_numpy(), self.leaves, values, meta)
+
+    def store(self):
+        """
+        Returns the columnar store, or None without NumPy.
+        """
+        if self._store is None:
+            if _numpy() is None:
+                return None
+            with self._lock:
+                if self._store is None:
+                    self._store = self.open_store(*self.read_columns())
+        return self._store
+
+    def records(self):
+        """
+        Returns every record: lazy Record mappings, or the unpickled
+        dictionaries when NumPy is missing.
+        """
+        if self._records is None:
+            store = self.store()
+            with self._lock:
+                if self._records is None and store is None:
+                    self._records = self.unpickle()
+                elif self._records is None:
+                    self._records = [Record(store, row, store.tree)
+                                     for row in range(store.length)]
+        return self._records
+
+    def get(self, where=None):
+        """
+        Returns every record, or only those matching where: a dict from leaf
+        path to a value or an inclusive (low, high) range.
+        """
+        records = self.records()
+        if not where:
+            return records
+        check_where(self.leaves, where)
+        store = self.store()
+        if store is None:
+            return [record for record in records if matches(record, where)]
+        return [records[row] for row in select_rows(store, where)]
+
+    def iter(self, fields=None, batch_size=None):
+        """
+        Iterates over the records, keeping only the given fields, without
+        holding them all in memory. With a batch_size, yields NumPy
+        structured arrays of up to batch_size records instead.
+        """
+        paths = select_leaves(self.leaves, fields)
+        if _numpy() is None:
+            if batch_size is not None:
+                raise DatasetException("Batches need NumPy; install it with "
+                                       "\"pip install numpy\".")
+            for record in nest(paths, ([lookup(record, path)
+                                        for path in paths]
+                                       for record in self.unpickle())):
+                yield record
+            return
+        store = self._store or self.open_store(*self.read_columns())
+        for batch in iter_batches(store, paths, batch_size or 1024):
+            if batch_size is not None:
+                yield batch
+                continue
+            for record in nest(paths, batch.tolist()):
+                yield record
+
+    def column(self, path):
+        """
+        Returns one leaf as a read-only NumPy array with a value per record;
+        numeric leaves are zero-copy views of the memory-mapped columns.
+        """
+        store = self.store()
+        if store is None:
+            raise DatasetException("Columns need NumPy; install it with "
+                                   "\"pip install numpy\".")
+        if path not in store.positions and path not in store.others:
+            raise DatasetException("Error! There is no \"{0}\" column."
+                                   .format(path))
+        return store.column(path)
+
+
+def select_rows(store, where):
+    """
+    Returns the sorted rows of a store that satisfy every condition of
+    where (see check_where).
+    """
+    np = _numpy()
+    rows = None
+    for path, condition in where.items():
+        matched = store.rows(path, condition)
+        rows = matched if rows is None else np.intersect1d(rows, matched)
+    return rows
+
+
+def select_leaves(leaves, fields=None):
+    """
+    Returns the leaf paths named by fields, in schema order. A field may be
+    a leaf ("time.year") or any prefix of one ("annual.private").
+    """
+    paths = [path for path, _ in leaves]
+    if fields is None:
+        return paths
+    selected = set()
+    for field in fields:
+        matched = [path for path in paths
+                   if path == field or path.startswith(field + ".")]
+        if not matched:
+            raise DatasetException("Error! There is no \"{0}\" field."
+                                   .format(field))
+        selected.update(matched)
+    return [path for path in paths if path in selected]
+
+
+def iter_batches(store, paths, batch_size):
+    """
+    Yields the given leaves of a store batch_size records at a time as NumPy
+    structured arrays. Integer and boolean leaves keep their dtype.
+    """
+    np = _numpy()
+    dtype = []
+    for path in paths:
+        if path in store.others:
+            dtype.append((path, store.others[path].dtype))
+        else:
+            dtype.append((path, {'int': np.int64, 'bool': np.bool_,
+                                 'float': np.float64}[
+                                     store.kinds[store.positions[path]]]))
+    for start in range(0, store.length, batch_size):
+        stop = min(start + batch_size, store.length)
+        batch = np.empty(stop - start, dtype=dtype)
+        for path in paths:
+            batch[path] = store.column(path)[start:stop]
+        yield batch
+
+
+_TEMPLATE = """'''
+Hello! Thank you for downloading a CORGIS library. However, you do not
+need to open this file. Instead you should make your own Python file and
+add the following line:
+
+import {module}
+
+Then just place the files you downloaded alongside it, together with
+corgis_loader.py.
+'''
+
+import os as _os
+
+import corgis_loader as _corgis_loader
+
+__all__ = [{exports}]
+
+{definitions}
+
+DatasetException = _corgis_loader.DatasetException
+
+_LOADER = _corgis_loader.Loader(
+    _os.path.join(_os.path.dirname(__file__), "{data}"),
+    _tifa_definitions, "{function}")
+if not _os.environ.get("CORGIS_LAZY_IMPORT"):
+    _LOADER.check()
+
+def {function}(where=None):
+    \"\"\"
+    Retrieves all of the {noun}, or only those matching where: a dict
+    from a field such as "{example}" to a value or an inclusive
+    (low, high) range.
+    \"\"\"
+    return _LOADER.get(where)
+
+def {iterator}(fields=None, batch_size=None):
+    \"\"\"
+    Iterates over the {noun} without keeping them in memory, optionally
+    keeping only some fields. With a batch_size, yields NumPy structured
+    arrays of up to batch_size records instead.
+    \"\"\"
+    return _LOADER.iter(fields, batch_size)
+
+def get_column(path):
+    \"\"\"
+    Retrieves a single field, such as "{example}", as a read-only NumPy
+    array with one value per record.
+    \"\"\"
+    return _LOADER.column(path)
+
+if __name__ == '__main__':
+    from timeit import default_timer as _default_timer
+
+    print(">>> {function}()")
+
+    start_time = _default_timer()
+    result = {function}()
+    print("Time taken: {{}}".format(_default_timer() - start_time))
+"""
+
+
+def generate(source, module=None):
+    """
+    Returns the source of a fast loader module for the CORGIS module whose
+    source is given. The new module keeps the original's _tifa_definitions
+    and record getter and adds an iter_ variant and get_column.
+    """
+    import ast
+    tree = ast.parse(source)
+    definitions = None
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == "_tifa_definitions":
+            definitions = ast.get_source_segment(source, node)
+    if definitions is None:
+        raise DatasetException("Error! The module has no _tifa_definitions().")
+    namespace = {}
+    exec(compile(ast.Module([node for node in tree.body
+                             if isinstance(node, ast.FunctionDef)
+                             and node.name == "_tifa_definitions"],
+                            type_ignores=[]), "<schema>", "exec"), namespace)
+    schema = namespace["_tifa_definitions"]()
+    getters = record_getters(schema)
+    if len(getters) != 1:
+        raise DatasetException("Error! Expected exactly one record getter, "
+                               "found {0}.".format(", ".join(getters) or "none"))
+    function = getters[0]
+    noun = function[len("get_"):] if function.startswith("get_") else function
+    iterator = "iter_" + noun
+    data = None
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Constant) and isinstance(node.value, str)
+                and node.value.endswith(".data")):
+            data = node.value
+    if module is None:
+        module = os.path.splitext(data)[0] if data else noun
+    leaves = compile_schema(schema, function)
+    example = next((path for path, kind in leaves if kind == "NumType"),
+                   leaves[0][0])
+    return _TEMPLATE.format(module=module, data=data or module + ".data",
+                            function=function, iterator=iterator, noun=noun,
+                            example=example, definitions=definitions,
+                            exports=", ".join(repr(name) for name in
+                                              (function, iterator,
+                                               "get_column")))
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Generate a fast loader for a CORGIS dataset module.")
+    parser.add_argument("module", help="the downloaded CORGIS .py file")
+    parser.add_argument("--output", required=True,
+                        help="directory to write the generated module to")
+    args = parser.parse_args(argv)
+    with open(args.module) as source:
+        text = generate(source.read())
+    os.makedirs(args.output, exist_ok=True)
+    target = os.path.join(args.output, os.path.basename(args.module))
+    if os.path.abspath(target) == os.path.abspath(args.module):
+        parser.error("refusing to overwrite the original module")
+    with open(target, "w") as output:
+        output.write(text)
+    print("wrote", target)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
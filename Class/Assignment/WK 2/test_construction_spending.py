@@ -0,0 +1,102 @@
+import gc
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import construction_spending
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Loads the columns from eight threads at once on a cold cache.
+_THREADS = """
+import threading
+import construction_spending
+errors = []
+def load():
+    try:
+        construction_spending.get_column("annual.private.residential").sum()
+        construction_spending.get_spending(year=2010)
+    except Exception as error:
+        errors.append(error)
+threads = [threading.Thread(target=load) for _ in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+assert not errors, errors
+"""
+
+
+def _copy(directory, names):
+    for name in names:
+        shutil.copy(os.path.join(HERE, name), str(directory))
+
+
+def _segment_exists(name):
+    try:
+        segment = construction_spending._open_segment(name)
+    except FileNotFoundError:
+        return False
+    segment.close()
+    return True
+
+
+def test_release_shared_dataset_while_in_use_can_be_retried():
+    name = "cs_test_{0}".format(os.getpid())
+    construction_spending.create_shared_dataset(name)
+    try:
+        record = construction_spending.get_spending()[0]
+        with pytest.raises(construction_spending.DatasetException):
+            construction_spending.release_shared_dataset(unlink=True)
+        # Still attached and still there for other processes.
+        assert _segment_exists(name)
+        assert record["time"]["year"] > 0
+        del record
+        gc.collect()
+        construction_spending.release_shared_dataset(unlink=True)
+        assert not _segment_exists(name)
+    finally:
+        gc.collect()
+        construction_spending.release_shared_dataset(unlink=True)
+
+
+def test_cold_load_from_many_threads(tmp_path):
+    _copy(tmp_path, ("construction_spending.py", "corgis_loader.py",
+                     "construction_spending.data"))
+    for _ in range(4):
+        for name in os.listdir(str(tmp_path)):
+            if ".corgis." in name:
+                os.remove(str(tmp_path / name))
+        subprocess.run([sys.executable, "-c", _THREADS], cwd=str(tmp_path),
+                       check=True)
+        assert not [name for name in os.listdir(str(tmp_path))
+                    if name.endswith(".tmp")]
+
+
+def test_convert_rewrites_a_format_written_from_older_data(tmp_path):
+    pytest.importorskip("pyarrow")
+    pandas = pytest.importorskip("pandas")
+    _copy(tmp_path, ("construction_spending.py", "corgis_loader.py",
+                     "construction_spending.data",
+                     "construction_spending_convert.py"))
+
+    def convert(fmt):
+        subprocess.run([sys.executable, "construction_spending_convert.py",
+                        "out", "--format", fmt], cwd=str(tmp_path),
+                       check=True, stdout=subprocess.PIPE)
+    convert("parquet")
+    data = str(tmp_path / "construction_spending.data")
+    with open(data, "rb") as source:
+        dataset = pickle.load(source)
+    dataset[0]["annual"]["private"]["residential"] = -1.0
+    with open(data, "wb") as output:
+        pickle.dump(dataset, output)
+    convert("arrow")
+    convert("parquet")
+    table = pandas.read_parquet(
+        str(tmp_path / "out" / "construction_spending.parquet"))
+    assert table["annual.private.residential"].min() == -1.0
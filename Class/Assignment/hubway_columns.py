@@ -0,0 +1,356 @@
+'''
+Columnar snapshot of hubway.db for scans that read one or two columns of
+trips. SQLite stores trips row by row, so even SELECT duration FROM trips
+reads every column of every trip; the snapshot keeps each column of trips
+and stations in its own memory-mapped NumPy file instead, with strings
+dictionary-encoded and trips sorted by start_date:
+
+    python hubway_columns.py            # writes hubway.columns/
+
+hubway.db stays the source of truth: load() rebuilds the snapshot whenever
+the database has changed since it was taken. The query layer answers the
+notebook-style filters, joins and aggregates with array operations:
+
+    import hubway_columns
+    snapshot = hubway_columns.load()
+    trips = snapshot.trips
+    ((trips['duration'] >= 9990) & (trips['sub_type'] == 'Registered')).sum()
+    trips['duration'][snapshot.between('2012-01-01', '2013-01-01')].mean()
+    snapshot.aggregate('bike_number', 'duration', 'sum')
+    round_trips = trips['start_station'] == trips['end_station']
+    snapshot.aggregate(snapshot.station('station'), mask=round_trips)
+
+String columns come back as pandas Categoricals over their codes, dates as
+datetime64[s] and integer columns as the narrowest integer type that holds
+them (float64 when they have NULLs).
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import hubway
+
+TABLES = ('trips', 'stations')
+DATES = {'trips': ('start_date', 'end_date')}
+ORDER = {'trips': 'start_date', 'stations': 'id'}
+META_NAME = 'meta.json'
+
+
+def directory_for(path):
+    return os.path.splitext(path)[0] + '.columns'
+
+
+def _stamp(path):
+    stamp = []
+    for name in (path, path + '-wal'):
+        try:
+            stat = os.stat(name)
+        except OSError:
+            stamp.append(None)
+        else:
+            stamp.append([stat.st_size, stat.st_mtime_ns])
+    return stamp
+
+
+def _narrow(values):
+    """
+    Returns integer values in the smallest integer type that holds them.
+    """
+    if not len(values):
+        return values.astype(np.int8)
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= values.min() and values.max() <= info.max:
+            return values.astype(dtype)
+    return values.astype(np.int64)
+
+
+def _encode(connection, table, column, declared, order):
+    """
+    Returns (array, dictionary, kind) for one column, in snapshot order.
+    """
+    values = pd.read_sql_query('SELECT "{0}" FROM "{1}" ORDER BY rowid'
+                               .format(column, table), connection)[column]
+    values = values.iloc[order].reset_index(drop=True)
+    if column in DATES.get(table, ()):
+        dates = pd.to_datetime(values, errors='coerce').to_numpy(
+            dtype='datetime64[s]')
+        return dates.view(np.int64), None, 'date'
+    if 'INT' in declared.upper() or 'REAL' in declared.upper() or (
+            not declared and pd.api.types.is_numeric_dtype(values)):
+        numbers = pd.to_numeric(values, errors='coerce')
+        if 'INT' in declared.upper() and not numbers.isna().any():
+            return _narrow(numbers.to_numpy(dtype=np.int64)), None, 'int'
+        return numbers.to_numpy(dtype=np.float64), None, 'float'
+    codes, dictionary = pd.factorize(values, sort=True)
+    return (_narrow(codes), [str(value) for value in dictionary],
+            'dictionary')
+
+
+def snapshot(path=hubway.DATABASE, directory=None):
+    """
+    Writes the columns of trips and stations to directory (hubway.columns
+    next to the database by default) and returns the directory. The
+    previous snapshot's files are kept until the next one, since readers
+    may still have them mapped; older files are removed where the system
+    allows (Windows won't remove a file that is still mapped).
+    """
+    directory = directory or directory_for(path)
+    os.makedirs(directory, exist_ok=True)
+    try:
+        with open(os.path.join(directory, META_NAME)) as source:
+            previous = json.load(source)['generation']
+    except (OSError, ValueError, KeyError):
+        previous = None
+    stamp = _stamp(path)
+    generation = '{0:x}'.format(time.time_ns())
+    meta = {'database': os.path.abspath(path), 'stamp': stamp,
+            'generation': generation, 'tables': {}}
+    connection = hubway.connect(path)
+    try:
+        for table in TABLES:
+            declared = [(row[1], row[2]) for row in connection.execute(
+                'PRAGMA table_info("{0}")'.format(table))]
+            key = pd.read_sql_query(
+                'SELECT "{0}" FROM "{1}" ORDER BY rowid'.format(
+                    ORDER[table], table), connection)[ORDER[table]]
+            if ORDER[table] in DATES.get(table, ()):
+                key = pd.to_datetime(key, errors='coerce')
+            order = np.argsort(key.to_numpy(), kind='stable')
+            columns = {}
+            for column, kind in declared:
+                array, dictionary, kind = _encode(connection, table, column,
+                                                  kind, order)
+                np.save(os.path.join(directory, '{0}.{1}.{2}.npy'.format(
+                    generation, table, column)), array)
+                columns[column] = {'kind': kind, 'dictionary': dictionary}
+            meta['tables'][table] = {'rows': len(order), 'columns': columns,
+                                     'order': ORDER[table]}
+    finally:
+        connection.close()
+    temporary = os.path.join(directory, META_NAME + '.tmp')
+    with open(temporary, 'w') as output:
+        json.dump(meta, output)
+    os.replace(temporary, os.path.join(directory, META_NAME))
+    kept = tuple(current + '.' for current in (generation, previous)
+                 if current)
+    for name in os.listdir(directory):
+        if name.endswith('.npy') and not name.startswith(kept):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                # Still mapped somewhere; the next snapshot tries again.
+                pass
+    return directory
+
+
+class Table(object):
+    """
+    The memory-mapped columns of one table. table[name] returns a column:
+    a NumPy array, a datetime64[s] array or a pandas Categorical.
+    """
+
+    def __init__(self, directory, generation, name, meta):
+        self.name = name
+        self.rows = meta['rows']
+        self.order = meta['order']
+        self._meta = meta['columns']
+        self._arrays = dict(
+            (column, np.load(os.path.join(directory, '{0}.{1}.{2}.npy'.format(
+                generation, name, column)), mmap_mode='r'))
+            for column in self._meta)
+
+    @property
+    def columns(self):
+        return list(self._meta)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, column):
+        if column not in self._meta:
+            raise KeyError('{0} has no column {1!r}'.format(self.name, column))
+        array = self._arrays[column]
+        kind = self._meta[column]['kind']
+        if kind == 'date':
+            return array.view('datetime64[s]')
+        if kind == 'dictionary':
+            return pd.Categorical.from_codes(
+                array, self._meta[column]['dictionary'], validate=False)
+        return array
+
+    def codes(self, column):
+        """
+        Returns the raw codes of a dictionary-encoded column (-1 for NULL)
+        and its dictionary.
+        """
+        return self._arrays[column], self._meta[column]['dictionary']
+
+    def frame(self, columns=None, rows=slice(None)):
+        """
+        Returns some columns (all by default) of some rows (a slice, mask
+        or positions) as a DataFrame.
+        """
+        return pd.DataFrame(dict((column, self[column][rows])
+                                 for column in (columns or self.columns)))
+
+
+class Snapshot(object):
+    """
+    The trips and stations of a snapshot, with joins and aggregates over
+    them.
+    """
+
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.stamp = meta['stamp']
+        for name in TABLES:
+            setattr(self, name, Table(directory, meta['generation'], name,
+                                      meta['tables'][name]))
+
+    def between(self, start=None, end=None):
+        """
+        Returns the slice of trips whose start_date is in [start, end),
+        found by binary search on the sorted dates.
+        """
+        dates = self.trips['start_date']
+        low = 0 if start is None else np.searchsorted(
+            dates, np.datetime64(start, 's'), 'left')
+        high = len(dates) if end is None else np.searchsorted(
+            dates, np.datetime64(end, 's'), 'left')
+        return slice(int(low), int(high))
+
+    def station(self, column, by='start_station'):
+        """
+        Returns a stations column joined to every trip through its
+        start_station (or end_station); trips whose station is unknown get
+        NULL.
+        """
+        ids = np.asarray(self.stations['id'])
+        wanted = np.asarray(self.trips[by])
+        positions = np.searchsorted(ids, wanted)
+        positions[positions == len(ids)] = 0
+        found = (ids[positions] == wanted) if len(ids) else \
+            np.zeros(len(wanted), dtype=bool)
+        if self.stations._meta[column]['kind'] == 'dictionary':
+            codes, dictionary = self.stations.codes(column)
+            joined = np.where(found, codes[positions] if len(ids) else -1, -1)
+            return pd.Categorical.from_codes(joined.astype(codes.dtype),
+                                             dictionary, validate=False)
+        values = np.asarray(self.stations[column])
+        if not len(ids):
+            return np.full(len(wanted), np.nan)
+        return np.where(found, values[positions], np.nan)
+
+    def _key(self, key):
+        """
+        Returns (codes, labels) for a grouping key: a trips column name or
+        an array with a value per trip.
+        """
+        values = self.trips[key] if isinstance(key, str) else key
+        if isinstance(values, pd.Categorical):
+            return np.asarray(values.codes), np.asarray(values.categories,
+                                                        dtype=object)
+        values = np.asarray(values)
+        if values.dtype.kind in 'iu' and len(values):
+            low = int(values.min())
+            if int(values.max()) - low < 4 * len(values) + 1024:
+                return (values - low).astype(np.intp), \
+                    np.arange(low, int(values.max()) + 1)
+        missing = pd.isna(values)
+        labels, codes = np.unique(values[~missing], return_inverse=True)
+        full = np.full(len(values), -1, dtype=np.intp)
+        full[~missing] = codes
+        return full, labels
+
+    def aggregate(self, by, column=None, how='count', mask=None):
+        """
+        Returns a Series, indexed by the groups that have trips, of the
+        count of trips or the sum, mean, min or max of a trips column,
+        grouped by one key or a list of keys (column names or arrays such
+        as station()). mask limits it to some trips. NULL keys and values
+        are left out.
+        """
+        keys = by if isinstance(by, list) else [by]
+        names = [key if isinstance(key, str) else None for key in keys]
+        codes, labels = zip(*[self._key(key) for key in keys])
+        valid = np.ones(len(self.trips), dtype=bool)
+        for key_codes in codes:
+            valid &= key_codes >= 0
+        values = None
+        if column is not None:
+            values = np.asarray(self.trips[column], dtype=np.float64)
+            valid &= ~np.isnan(values)
+        if isinstance(mask, slice):
+            selected = np.zeros(len(valid), dtype=bool)
+            selected[mask] = True
+            valid &= selected
+        elif mask is not None:
+            valid &= np.asarray(mask, dtype=bool)
+        shape = tuple(len(label) for label in labels)
+        group = np.ravel_multi_index([key_codes[valid] for key_codes in codes],
+                                     shape)
+        size = int(np.prod(shape))
+        counts = np.bincount(group, minlength=size)
+        if how == 'count':
+            result = counts
+        elif how in ('sum', 'mean'):
+            result = np.bincount(group, values[valid], minlength=size)
+            if how == 'mean':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    result = result / counts
+        elif how in ('min', 'max'):
+            result = np.full(size, np.inf if how == 'min' else -np.inf)
+            (np.minimum if how == 'min' else np.maximum).at(
+                result, group, values[valid])
+        else:
+            raise ValueError('Unknown aggregate {0!r}'.format(how))
+        present = np.flatnonzero(counts)
+        if len(keys) == 1:
+            index = pd.Index(labels[0][present], name=names[0])
+        else:
+            index = pd.MultiIndex.from_arrays(
+                [label[position] for label, position in
+                 zip(labels, np.unravel_index(present, shape))], names=names)
+        return pd.Series(result[present], index=index, name=how)
+
+
+def load(path=hubway.DATABASE, directory=None, refresh=True):
+    """
+    Returns the Snapshot of the database at path, taking a new one first if
+    there is none or (with refresh) the database has changed since.
+    """
+    directory = directory or directory_for(path)
+    try:
+        with open(os.path.join(directory, META_NAME)) as source:
+            meta = json.load(source)
+    except (OSError, ValueError):
+        meta = None
+    if meta is None or (refresh and meta['stamp'] != _stamp(path)):
+        snapshot(path, directory)
+        with open(os.path.join(directory, META_NAME)) as source:
+            meta = json.load(source)
+    return Snapshot(directory, meta)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Write a columnar snapshot of hubway.db.")
+    parser.add_argument('--db', default=hubway.DATABASE)
+    parser.add_argument('--output', help="snapshot directory")
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    directory = snapshot(args.db, args.output)
+    print('wrote {0} in {1:.2f} s'.format(directory,
+                                          time.perf_counter() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+'''
+Pre-binned heatmap data for the Hubway trips. folium.plugins.HeatMap is fed
+one [lat, lng, weight] row per point, which is fine for the 140 stations
+but not for the start or end of every trip. A Grid bins points into the
+cells of a Web Mercator grid at every zoom level instead (cell_px pixels
+wide on screen at that zoom), keeping only the cells that have points:
+
+    import hubway_grid, map_layers
+    grid = hubway_grid.trip_grid('start')
+    grid.level(13)          # lat, lng, count, weight of the non-empty cells
+    map_layers.zoom_heatmap(grid.levels()).add_to(trips_heatmap)
+
+The finest level is binned from the points with bincount; each coarser
+level merges 2x2 cells of the one below, and every level is computed once
+and kept. A cell's location is the weighted centroid of its points and its
+weight is its count over the level's largest count. trip_grid() counts the
+trips per station in SQLite first and keeps its grids until hubway.db
+changes.
+'''
+
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import hubway
+
+ZOOMS = tuple(range(10, 19))
+CELL_PIXELS = 8
+TILE_PIXELS = 256
+MAX_LATITUDE = 85.0511287798
+CACHE_SIZE = 16
+
+_grids = OrderedDict()
+_grids_lock = threading.Lock()
+
+
+def _mercator(lat, lng):
+    """
+    Returns the Web Mercator x and y of points, from 0 to 1 across the
+    world (y grows southwards).
+    """
+    sine = np.sin(np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE)))
+    return ((np.asarray(lng) + 180.0) / 360.0,
+            0.5 - np.log((1 + sine) / (1 - sine)) / (4 * math.pi))
+
+
+def _bin(ix, iy, values):
+    """
+    Sums every array of values over the distinct cells (ix, iy), like a
+    sparse histogram2d; returns the cells' ix, iy and sums.
+    """
+    if not len(ix):
+        return ix, iy, [value[:0] for value in values]
+    low_x, low_y = ix.min(), iy.min()
+    width = int(ix.max() - low_x) + 1
+    size = width * (int(iy.max() - low_y) + 1)
+    if size <= 4 * len(ix) + 1024:
+        code = (iy - low_y) * width + (ix - low_x)
+        present = np.flatnonzero(np.bincount(code, minlength=size))
+        return (present % width + low_x, present // width + low_y,
+                [np.bincount(code, value, minlength=size)[present]
+                 for value in values])
+    cells, code = np.unique((iy.astype(np.int64) << 32) | ix,
+                            return_inverse=True)
+    return (cells & 0xFFFFFFFF, cells >> 32,
+            [np.bincount(code, value, minlength=len(cells))
+             for value in values])
+
+
+class Grid(object):
+    """
+    Points (with optional weights) binned at every zoom level of zooms;
+    other zoom levels are binned on demand too.
+    """
+
+    def __init__(self, lat, lng, weights=None, zooms=ZOOMS,
+                 cell_px=CELL_PIXELS):
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        weights = np.ones(len(lat)) if weights is None else \
+            np.asarray(weights, dtype=np.float64)
+        located = ~(np.isnan(lat) | np.isnan(lng) | np.isnan(weights))
+        self._points = lat[located], lng[located], weights[located]
+        self.zooms = sorted(zooms)
+        self.cell_px = cell_px
+        self._cells = {}
+
+    def _level_cells(self, zoom):
+        """
+        Returns (ix, iy, [weight, weight * lat, weight * lng]) of the
+        level's non-empty cells.
+        """
+        cells = self._cells.get(zoom)
+        if cells is not None:
+            return cells
+        if zoom >= self.zooms[-1]:
+            lat, lng, weights = self._points
+            x, y = _mercator(lat, lng)
+            scale = 2.0 ** zoom * TILE_PIXELS / self.cell_px
+            cells = _bin(np.floor(x * scale).astype(np.int64),
+                         np.floor(y * scale).astype(np.int64),
+                         [weights, weights * lat, weights * lng])
+        else:
+            # A cell is exactly the 2x2 cells below it one zoom level in.
+            ix, iy, sums = self._level_cells(zoom + 1)
+            cells = _bin(ix >> 1, iy >> 1, sums)
+        self._cells[zoom] = cells
+        return cells
+
+    def level(self, zoom):
+        """
+        Returns the non-empty cells at zoom as a DataFrame of lat, lng,
+        count (the summed weights) and weight (count over the largest one).
+        """
+        _, _, (count, lat, lng) = self._level_cells(zoom)
+        kept = count > 0
+        count = count[kept]
+        return pd.DataFrame({'lat': lat[kept] / count,
+                             'lng': lng[kept] / count, 'count': count,
+                             'weight': count / count.max() if len(count)
+                             else count})
+
+    def levels(self):
+        """
+        Returns {zoom: level(zoom)} for the grid's zoom levels.
+        """
+        return dict((zoom, self.level(zoom)) for zoom in self.zooms)
+
+
+def trip_grid(end='start', where=None, params=None, zooms=ZOOMS,
+              cell_px=CELL_PIXELS, path=hubway.DATABASE):
+    """
+    Returns the Grid of where trips start (or end), weighted by trips, for
+    the trips matching where (which may use positional params).
+    """
+    if end not in ('start', 'end'):
+        raise ValueError("end must be 'start' or 'end', not {0!r}".format(end))
+    query = ('SELECT stations.lat AS lat, stations.lng AS lng, COUNT(*) AS '
+             'trips FROM trips INNER JOIN stations ON trips.{0}_station = '
+             'stations.id'.format(end))
+    if where:
+        query += ' WHERE ' + where
+    query += ' GROUP BY trips.{0}_station'.format(end)
+    # run_query's cache already notices changes to hubway.db, so a grid is
+    # reused for as long as it returns the same station counts.
+    points = hubway.run_query(query, params, path)
+    key = (os.path.abspath(path), hubway._normalize(query),
+           hubway._freeze(params), tuple(zooms), cell_px)
+    with _grids_lock:
+        cached = _grids.get(key)
+        if cached is not None and cached[0].equals(points):
+            _grids.move_to_end(key)
+            return cached[1]
+    grid = Grid(points['lat'], points['lng'], points['trips'], zooms, cell_px)
+    with _grids_lock:
+        _grids[key] = (points, grid)
+        _grids.move_to_end(key)
+        while len(_grids) > CACHE_SIZE:
+            _grids.popitem(last=False)
+    return grid
@@ -0,0 +1,378 @@
+'''
+Index advisor for hubway.db. hubway.db ships without secondary indexes, so
+every filter, GROUP BY and ORDER BY in the notebooks scans the whole trips
+table. The advisor takes a workload (the queries run through
+hubway.run_query, or the queries found in a notebook), reads each query's
+EXPLAIN QUERY PLAN, proposes covering indexes for the tables it scans,
+optionally builds them and reports the timings before and after:
+
+    python hubway_indexes.py Hubway-Plot-Map-SQL.py --build
+
+or, after running a notebook's cells:
+
+    import hubway_indexes
+    report = hubway_indexes.advise(build_indexes=True)
+
+An index is proposed as (equality columns, GROUP BY columns, ORDER BY
+columns, one range column, every other column the query reads), so the
+query can be answered from the index alone. Columns that are only
+aggregated (ORDER BY AVG(duration)) are not keys. Queries that read every column
+of a table get an index on their key columns only.
+'''
+
+import argparse
+import ast
+import re
+import sqlite3
+import statistics
+import sys
+import time
+
+import hubway
+
+# Quoted strings; double quotes too, since the notebooks use them for
+# string literals ("Registered") as often as for column aliases.
+_LITERAL = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*\"""")
+_TABLE = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(?!ON\b|WHERE\b|'
+                    r'JOIN\b|GROUP\b|ORDER\b|LIMIT\b|INNER\b|LEFT\b|CROSS\b)'
+                    r'(\w+))?', re.IGNORECASE)
+# An aggregate call; sorting or grouping by one needs the aggregated values
+# first, so the columns inside are no use as index keys.
+_AGGREGATE = re.compile(r'\b(?:COUNT|SUM|AVG|MIN|MAX|TOTAL|GROUP_CONCAT)\s*'
+                        r'\([^()]*\)', re.IGNORECASE)
+_CLAUSE = re.compile(r'\b(WHERE|ON|GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|JOIN|'
+                     r'INNER|LEFT|CROSS|UNION)\b', re.IGNORECASE)
+
+
+def notebook_queries(filename):
+    """
+    Returns the SQL queries written as string literals in a Python file,
+    such as one of the exported notebooks.
+    """
+    with open(filename) as source:
+        tree = ast.parse(source.read())
+    queries = []
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Constant) and isinstance(node.value, str)
+                and node.value.strip().upper().startswith('SELECT')):
+            queries.append(hubway._normalize(node.value))
+    return list(dict.fromkeys(queries))
+
+
+def explain(connection, query, params=None):
+    """
+    Returns the details of the query's EXPLAIN QUERY PLAN, one per step.
+    """
+    return [row[-1] for row in connection.execute(
+        'EXPLAIN QUERY PLAN ' + query, params or ())]
+
+
+def index_only(plan):
+    """
+    Tells whether a plan reads no table b-tree directly: every step is a
+    covering index, an integer primary key lookup or a constant.
+    """
+    for step in plan:
+        if step.startswith(('SCAN', 'SEARCH')) and not (
+                'COVERING INDEX' in step or 'INTEGER PRIMARY KEY' in step
+                or 'CONSTANT ROW' in step):
+            return False
+    return True
+
+
+def _columns_read(connection, query, params=None):
+    """
+    Returns {table: set of columns} for the columns the query reads, as
+    reported to an authorizer while the query is prepared.
+    """
+    read = {}
+
+    def authorizer(action, table, column, database, trigger):
+        if action == sqlite3.SQLITE_READ and table and column:
+            read.setdefault(table, set()).add(column)
+        return sqlite3.SQLITE_OK
+    connection.set_authorizer(authorizer)
+    try:
+        connection.execute('EXPLAIN ' + query, params or ()).fetchall()
+    finally:
+        connection.set_authorizer(None)
+    return read
+
+
+def _clauses(query):
+    """
+    Splits a query with its literals blanked out into its WHERE, ON, GROUP
+    BY and ORDER BY text.
+    """
+    text = _LITERAL.sub("''", query)
+    clauses = {'WHERE': '', 'ON': '', 'GROUP BY': '', 'ORDER BY': ''}
+    marks = list(_CLAUSE.finditer(text)) + [None]
+    for mark, following in zip(marks, marks[1:]):
+        name = re.sub(r'\s+', ' ', mark.group(1).upper())
+        if name in clauses:
+            end = following.start() if following else len(text)
+            clauses[name] += ' ' + text[mark.end():end]
+    return clauses
+
+
+def _position(text, column):
+    """
+    Returns where column is first mentioned in text (optionally qualified
+    by a table or alias), or None.
+    """
+    match = re.search(r'(?<![\w.])(?:\w+\.)?{0}\b'.format(re.escape(column)),
+                      text, re.IGNORECASE)
+    return match.start() if match else None
+
+
+def _equality(text, column):
+    return re.search(r'(?<![\w.])(?:\w+\.)?{0}\s*(?:=|==|\bIS\b|\bIN\b)\s*'
+                     r'(?:\?|:\w+|\'|-?\d|\()'.format(re.escape(column)),
+                     text, re.IGNORECASE) is not None
+
+
+def _table_columns(connection, table):
+    return [row[1] for row in connection.execute(
+        'PRAGMA table_info("{0}")'.format(table))]
+
+
+def _rowid_names(connection, table):
+    """
+    Returns the lowercased names of table's rowid: rowid, oid, _rowid_ and
+    its INTEGER PRIMARY KEY column, if it has one. Every index entry holds
+    the rowid already, so it is never worth a key column.
+    """
+    names = {'rowid', 'oid', '_rowid_'}
+    primary = [(row[1], row[2]) for row in connection.execute(
+        'PRAGMA table_info("{0}")'.format(table)) if row[5]]
+    if len(primary) == 1 and primary[0][1].upper() == 'INTEGER':
+        names.add(primary[0][0].lower())
+    return names
+
+
+def _existing_indexes(connection):
+    """
+    Returns {table: [column tuples]} for the indexes already in the
+    database.
+    """
+    indexes = {}
+    for table, name in connection.execute(
+            "SELECT tbl_name, name FROM sqlite_master WHERE type = 'index'"):
+        columns = tuple(row[2] for row in connection.execute(
+            'PRAGMA index_info("{0}")'.format(name)))
+        indexes.setdefault(table, []).append(columns)
+    return indexes
+
+
+def _candidate(connection, query, params, table, read):
+    """
+    Returns the column tuple of an index on table for query, or None if
+    the query has no filter, grouping or ordering on the table (other
+    than on its rowid).
+    """
+    rowid = _rowid_names(connection, table)
+    read = set(column for column in read if column.lower() not in rowid)
+    clauses = _clauses(query)
+    keys = []
+    for column in sorted(read):
+        if _equality(clauses['WHERE'], column):
+            keys.append(column)
+    for clause in ('GROUP BY', 'ORDER BY'):
+        text = _AGGREGATE.sub('', clauses[clause])
+        mentioned = [(_position(text, column), column)
+                     for column in read if column not in keys]
+        keys.extend(column for position, column in sorted(
+            entry for entry in mentioned if entry[0] is not None))
+    for column in sorted(read):
+        if column not in keys and (
+                _position(clauses['WHERE'], column) is not None
+                or _position(clauses['ON'], column) is not None):
+            keys.append(column)
+            break
+    if not keys:
+        return None
+    # The other filtered or joined columns come first, then the rest.
+    rest = sorted(read - set(keys), key=lambda column: (
+        _position(clauses['WHERE'], column) is None
+        and _position(clauses['ON'], column) is None, column))
+    if set(keys) | set(rest) >= set(
+            column for column in _table_columns(connection, table)
+            if column.lower() not in rowid):
+        return tuple(keys)
+    return tuple(keys) + tuple(rest)
+
+
+def propose(queries, path=hubway.DATABASE):
+    """
+    Returns [(table, columns)] for the indexes that would let the queries
+    (strings or (query, params[, runs]) tuples) avoid scanning tables.
+    Indexes that are a prefix of another proposal or of an existing index
+    are left out.
+    """
+    with hubway.get_service(path).connection() as connection:
+        existing = _existing_indexes(connection)
+        proposals = []
+        for entry in queries:
+            query, params = ((entry, None) if isinstance(entry, str)
+                             else entry[:2])
+            aliases = {}
+            for match in _TABLE.finditer(_LITERAL.sub("''", query)):
+                aliases[match.group(2) or match.group(1)] = match.group(1)
+                aliases[match.group(1)] = match.group(1)
+            scanned = set()
+            for step in explain(connection, query, params):
+                match = re.match(r'(?:SCAN|SEARCH) (\w+)', step)
+                if (match and 'COVERING INDEX' not in step
+                        and 'INTEGER PRIMARY KEY' not in step):
+                    scanned.add(aliases.get(match.group(1), match.group(1)))
+                elif 'TEMP B-TREE' in step:
+                    scanned.update(aliases.values())
+            for table, read in _columns_read(connection, query,
+                                             params).items():
+                if table in scanned:
+                    columns = _candidate(connection, query, params, table,
+                                         read)
+                    if columns:
+                        proposals.append((table, columns))
+    proposals = list(dict.fromkeys(proposals))
+    kept = []
+    for table, columns in proposals:
+        covered = [other for other_table, other in proposals
+                   if other_table == table and other != columns
+                   and other[:len(columns)] == columns]
+        covered += [other for other in existing.get(table, [])
+                    if other[:len(columns)] == columns]
+        if not covered:
+            kept.append((table, columns))
+    return kept
+
+
+def index_name(table, columns):
+    return 'advisor_{0}_{1}'.format(table, '_'.join(columns))
+
+
+def build(indexes, path=hubway.DATABASE):
+    """
+    Creates the indexes ([(table, columns)]) that don't exist yet and
+    refreshes the planner statistics. Returns the names created.
+    """
+    connection = sqlite3.connect(path)
+    created = []
+    try:
+        with connection:
+            for table, columns in indexes:
+                name = index_name(table, columns)
+                if connection.execute(
+                        "SELECT 1 FROM sqlite_master WHERE name = ?",
+                        (name,)).fetchone():
+                    continue
+                connection.execute('CREATE INDEX "{0}" ON "{1}" ({2})'.format(
+                    name, table, ', '.join('"{0}"'.format(column)
+                                           for column in columns)))
+                created.append(name)
+            if created:
+                connection.execute('ANALYZE')
+    finally:
+        connection.close()
+    return created
+
+
+def _measure(path, queries, repeat):
+    """
+    Returns the plan and the median wall time in milliseconds of every
+    query, each run on a fresh connection so no statement is cached.
+    """
+    results = []
+    for query, params in queries:
+        connection = hubway.connect(path)
+        try:
+            plan = explain(connection, query, params)
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                connection.execute(query, params or ()).fetchall()
+                times.append((time.perf_counter() - start) * 1000)
+        finally:
+            connection.close()
+        results.append({'plan': plan, 'ms': statistics.median(times)})
+    return results
+
+
+def advise(queries=None, path=hubway.DATABASE, build_indexes=False,
+           repeat=3):
+    """
+    Proposes indexes for the queries (by default the workload recorded by
+    hubway.run_query), builds them if build_indexes is set, and returns a
+    report: the proposed and created indexes and, for every query, its plan
+    and median time before and, when building, after.
+    """
+    if queries is None:
+        queries = hubway.get_service(path).workload()
+    queries = [(entry, None) if isinstance(entry, str) else tuple(entry[:2])
+               for entry in queries]
+    indexes = propose(queries, path)
+    before = _measure(path, queries, repeat)
+    report = {'indexes': [(table, columns, index_name(table, columns))
+                          for table, columns in indexes],
+              'created': [], 'queries': []}
+    after = before
+    if build_indexes and indexes:
+        report['created'] = build(indexes, path)
+        after = _measure(path, queries, repeat)
+    for (query, params), old, new in zip(queries, before, after):
+        entry = {'query': query, 'params': params,
+                 'before_ms': old['ms'], 'before_plan': old['plan'],
+                 'index_only': index_only(new['plan'])}
+        if build_indexes:
+            entry.update(after_ms=new['ms'], after_plan=new['plan'])
+        report['queries'].append(entry)
+    return report
+
+
+def _print_report(report, built):
+    for table, columns, name in report['indexes']:
+        state = ('created' if name in report['created']
+                 else 'exists' if built else 'proposed')
+        print('{0}: {1} ON {2}({3})'.format(state, name, table,
+                                            ', '.join(columns)))
+    for entry in report['queries']:
+        print()
+        print(entry['query'])
+        print('  before: {0:9.2f} ms  {1}'.format(
+            entry['before_ms'], '; '.join(entry['before_plan'])))
+        if built:
+            print('  after:  {0:9.2f} ms  {1}{2}'.format(
+                entry['after_ms'], '; '.join(entry['after_plan']),
+                '  (index only)' if entry['index_only'] else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Propose and build indexes for queries on hubway.db.")
+    parser.add_argument('sources', nargs='+',
+                        help="notebook .py files or .sql files of queries "
+                             "separated by semicolons")
+    parser.add_argument('--db', default=hubway.DATABASE)
+    parser.add_argument('--build', action='store_true',
+                        help="create the proposed indexes")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timed runs per query")
+    args = parser.parse_args(argv)
+    queries = []
+    for source in args.sources:
+        if source.endswith('.py'):
+            queries.extend(notebook_queries(source))
+        else:
+            with open(source) as sql:
+                queries.extend(hubway._normalize(query)
+                               for query in sql.read().split(';')
+                               if query.strip())
+    queries = [query for query in dict.fromkeys(queries)
+               if 'sqlite_master' not in query]
+    report = advise(queries, args.db, args.build, args.repeat)
+    _print_report(report, args.build)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+'''
+Parallel GROUP BY scans over the Hubway trips. SQLite runs a query on a
+single core, so a full scan such as
+
+    SELECT bike_number, COUNT(*), SUM(duration) FROM trips
+    GROUP BY bike_number
+
+leaves the rest of the machine idle. aggregate() splits trips into rowid
+ranges, has a pool of worker processes (each with its own read-only
+connection) aggregate the ranges, and merges the partial results:
+
+    import hubway_parallel
+    hubway_parallel.aggregate('bike_number', ['COUNT(*)', 'SUM(duration)'])
+
+COUNT, SUM, AVG, MIN and MAX are supported. compare() (or running this
+file) times the same query run serially through a hubway.QueryService and
+reports the speedup:
+
+    python hubway_parallel.py --by bike_number --measure "COUNT(*)" \\
+        --measure "SUM(duration)" --workers 4
+'''
+
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import hubway
+
+FUNCTIONS = ('COUNT', 'SUM', 'AVG', 'MIN', 'MAX')
+
+# Ranges per worker, so that a slow range doesn't leave the others idle.
+PARTITIONS_PER_WORKER = 4
+
+_MEASURE = re.compile(r'\s*(\w+)\s*\(\s*(\*|\w+)\s*\)\s*\Z')
+
+_connection = None
+
+
+def default_workers():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _parse(measure):
+    """
+    Splits a measure such as 'SUM(duration)' into ('SUM', 'duration').
+    """
+    match = _MEASURE.match(measure)
+    if not match or match.group(1).upper() not in FUNCTIONS:
+        raise ValueError('Unsupported measure {0!r}; expected one of {1} of '
+                         'a column'.format(measure, ', '.join(FUNCTIONS)))
+    function, column = match.group(1).upper(), match.group(2)
+    if column == '*' and function != 'COUNT':
+        raise ValueError('Only COUNT can take *: {0!r}'.format(measure))
+    return function, column
+
+
+def _total(values):
+    # Like SQL's SUM, the sum of no values is NULL rather than 0.
+    return pd.to_numeric(values).sum(min_count=1)
+
+
+def _partials(measures):
+    """
+    Returns the partial aggregates every range computes: (name, SQL, how
+    to merge them), with AVG split into a SUM and a COUNT.
+    """
+    partials = []
+    for function, column in measures:
+        parts = ([('SUM', column), ('COUNT', column)] if function == 'AVG'
+                 else [(function, column)])
+        for part in parts:
+            name = '{0}({1})'.format(*part)
+            if name not in [partial[0] for partial in partials]:
+                merge = {'COUNT': 'sum', 'SUM': _total, 'MIN': 'min',
+                         'MAX': 'max'}[part[0]]
+                partials.append((name, '{0}({1})'.format(
+                    part[0], '*' if part[1] == '*' else
+                    '"{0}"'.format(part[1])), merge))
+    return partials
+
+
+def _open(path):
+    global _connection
+    _connection = hubway.connect(path)
+
+
+def _run(task):
+    query, params = task
+    cursor = _connection.execute(query, params)
+    columns = [description[0] for description in cursor.description]
+    return pd.DataFrame(cursor.fetchall(), columns=columns)
+
+
+def _ranges(path, table, count):
+    connection = hubway.connect(path)
+    try:
+        low, high = connection.execute(
+            'SELECT MIN(rowid), MAX(rowid) FROM "{0}"'.format(table)).fetchone()
+    finally:
+        connection.close()
+    if low is None:
+        return []
+    step = max(1, -(-(high - low + 1) // count))
+    return [(start - 1, min(start + step - 1, high))
+            for start in range(low, high + 1, step)]
+
+
+def aggregate(by, measures, where=None, params=None, workers=None,
+              table='trips', path=hubway.DATABASE):
+    """
+    Returns the result of SELECT by..., measures... FROM table WHERE where
+    GROUP BY by... as a DataFrame, computed over rowid ranges by workers
+    processes. by is a column or a list of columns (or empty for a single
+    row of totals), measures are strings like 'AVG(duration)', and where
+    may use positional params.
+    """
+    keys = [by] if isinstance(by, str) else list(by or ())
+    measures = [measures] if isinstance(measures, str) else list(measures)
+    parsed = [_parse(measure) for measure in measures]
+    partials = _partials(parsed)
+    workers = workers or default_workers()
+    columns = ['"{0}"'.format(key) for key in keys]
+    query = 'SELECT {0} FROM "{1}" WHERE rowid > ? AND rowid <= ?'.format(
+        ', '.join(columns + ['{0} AS "{1}"'.format(sql, name)
+                             for name, sql, _ in partials]), table)
+    if where:
+        query += ' AND ({0})'.format(where)
+    if keys:
+        query += ' GROUP BY ' + ', '.join(columns)
+    tasks = [(query, [low, high] + list(params or ()))
+             for low, high in _ranges(path, table,
+                                      workers * PARTITIONS_PER_WORKER)]
+    if workers == 1:
+        _open(path)
+        results = [_run(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers, _open, (path,)) as pool:
+            results = pool.map(_run, tasks)
+    names = [name for name, _, _ in partials]
+    merged = pd.concat(results, ignore_index=True) if results else \
+        pd.DataFrame(columns=keys + names)
+    how = dict((name, merge) for name, _, merge in partials)
+    if keys:
+        merged = merged.groupby(keys, dropna=False, sort=True).agg(
+            how).reset_index()
+    else:
+        merged = merged.agg(how).to_frame().T
+    # COUNT of no rows is 0.
+    for name, _, merge in partials:
+        if name.startswith('COUNT'):
+            merged[name] = merged[name].fillna(0).astype('int64')
+    result = merged[keys].copy()
+    for measure, (function, column) in zip(measures, parsed):
+        if function == 'AVG':
+            total = merged['SUM({0})'.format(column)]
+            count = merged['COUNT({0})'.format(column)]
+            result[measure] = total / count.where(count > 0)
+        else:
+            result[measure] = merged['{0}({1})'.format(function, column)]
+    return result
+
+
+def _same(left, right):
+    """
+    Tells whether two results hold the same values, whether missing ones
+    are None or NaN, allowing for rounding in sums of floats.
+    """
+    if len(left) != len(right):
+        return False
+    for column in left.columns:
+        try:
+            ours = pd.to_numeric(left[column]).astype(float)
+            theirs = pd.to_numeric(right[column]).astype(float)
+        except (TypeError, ValueError):
+            if ([value if pd.notna(value) else None for value in left[column]]
+                    != [value if pd.notna(value) else None
+                        for value in right[column]]):
+                return False
+        else:
+            if not np.allclose(ours, theirs, rtol=1e-9, atol=0,
+                               equal_nan=True):
+                return False
+    return True
+
+
+def compare(by, measures, where=None, params=None, workers=None,
+            table='trips', path=hubway.DATABASE):
+    """
+    Runs the aggregate serially through a QueryService of its own that
+    caches nothing (leaving the shared service's cache alone) and in
+    parallel, and returns both timings, the speedup and whether the
+    results agree.
+    """
+    keys = [by] if isinstance(by, str) else list(by or ())
+    measures = [measures] if isinstance(measures, str) else list(measures)
+    workers = workers or default_workers()
+    query = 'SELECT {0} FROM "{1}"'.format(
+        ', '.join(['"{0}"'.format(key) for key in keys] + measures), table)
+    if where:
+        query += ' WHERE ' + where
+    if keys:
+        query += ' GROUP BY ' + ', '.join('"{0}"'.format(key) for key in keys)
+    service = hubway.QueryService(path, pool_size=1, cache_size=0)
+    try:
+        start = time.perf_counter()
+        serial = service.run_query(query, params)
+        serial_s = time.perf_counter() - start
+    finally:
+        service.close()
+    start = time.perf_counter()
+    parallel = aggregate(keys, measures, where, params, workers, table, path)
+    parallel_s = time.perf_counter() - start
+    serial.columns = parallel.columns
+    if keys:
+        serial = serial.sort_values(keys).reset_index(drop=True)
+        parallel = parallel.sort_values(keys).reset_index(drop=True)
+    equal = _same(serial, parallel)
+    return {'query': query, 'workers': workers, 'serial_s': serial_s,
+            'parallel_s': parallel_s, 'speedup': serial_s / parallel_s,
+            'equal': equal}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare serial and parallel GROUP BY scans of trips.")
+    parser.add_argument('--db', default=hubway.DATABASE)
+    parser.add_argument('--by', nargs='*', default=['bike_number'])
+    parser.add_argument('--measure', action='append',
+                        help="an aggregate such as 'SUM(duration)'; "
+                             "repeatable")
+    parser.add_argument('--where')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    report = compare(args.by, args.measure or ['COUNT(*)', 'SUM(duration)'],
+                     args.where, workers=args.workers, path=args.db)
+    print(report['query'])
+    print('serial {serial_s:.3f} s, parallel {parallel_s:.3f} s with '
+          '{workers} workers: {speedup:.2f}x, results {0}'.format(
+              'agree' if report['equal'] else 'DIFFER', **report))
+    return 0 if report['equal'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+'''
+Query profiler and slow-query log for hubway.db. Once enabled, every query
+that hubway.run_query sends to SQLite (cache hits are free and not
+recorded) is timed and described:
+
+* wall time, split into running the statement and building the DataFrame
+* SQLite virtual machine steps, counted with a progress handler
+* rows returned
+* the EXPLAIN QUERY PLAN of the query
+
+    import hubway_profile
+    profiler = hubway_profile.enable(slow_ms=100)
+    ...  # run the notebook
+    profiler.report()
+
+Queries slower than slow_ms are appended to the slow-query log
+(hubway_slow.log, one JSON object per line), and report() returns a
+DataFrame with the percentiles of every distinct query, most expensive
+first. Cells that call pd.read_sql_query(query, db) directly can use
+profiler.read_sql_query(query, db) instead. To profile every query in a
+notebook at once:
+
+    python hubway_profile.py Hubway-Plot-Map-SQL.py
+'''
+
+import argparse
+import collections
+import json
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import hubway
+
+LOG_NAME = 'hubway_slow.log'
+
+
+class Profiler(object):
+    """
+    Runs queries the way pd.read_sql_query does while recording what they
+    cost. Keeps the last `keep` runs of every distinct query.
+    """
+
+    def __init__(self, slow_ms=100.0, log=LOG_NAME, step_interval=1000,
+                 keep=1000):
+        self.slow_ms = slow_ms
+        self.log = log
+        self.step_interval = step_interval
+        self.keep = keep
+        self._runs = collections.OrderedDict()
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def _plan(self, connection, key, query, params):
+        with self._lock:
+            plan = self._plans.get(key)
+        if plan is None:
+            try:
+                plan = [row[-1] for row in connection.execute(
+                    'EXPLAIN QUERY PLAN ' + query, params or ())]
+            except Exception as error:
+                plan = ['(no plan: {0})'.format(error)]
+            with self._lock:
+                self._plans[key] = plan
+        return plan
+
+    def read_sql_query(self, query, connection, params=None):
+        """
+        Returns the query's result as a DataFrame, like pd.read_sql_query
+        on a sqlite3 connection, and records the run.
+        """
+        steps = [0]
+
+        def progress():
+            steps[0] += 1
+            return 0
+        connection.set_progress_handler(progress, self.step_interval)
+        try:
+            start = time.perf_counter()
+            cursor = connection.execute(query, params or ())
+            rows = cursor.fetchall()
+            executed = time.perf_counter()
+        finally:
+            connection.set_progress_handler(None, 0)
+        columns = [description[0] for description in cursor.description or ()]
+        result = pd.DataFrame.from_records(rows, columns=columns,
+                                           coerce_float=True)
+        built = time.perf_counter()
+        key = hubway._normalize(query)
+        run = {'time': time.time(), 'wall_ms': (built - start) * 1000,
+               'sql_ms': (executed - start) * 1000,
+               'frame_ms': (built - executed) * 1000,
+               'steps': steps[0] * self.step_interval, 'rows': len(rows)}
+        plan = self._plan(connection, key, query, params)
+        with self._lock:
+            self._runs.setdefault(key, collections.deque(
+                maxlen=self.keep)).append(run)
+        if self.log and run['wall_ms'] >= self.slow_ms:
+            entry = dict(run, query=key, plan=plan,
+                         params=None if params is None else list(params))
+            with self._lock, open(self.log, 'a') as log:
+                log.write(json.dumps(entry, default=str) + '\n')
+        return result
+
+    def report(self):
+        """
+        Returns a DataFrame with a row per distinct query: how often it ran,
+        its total time and wall time percentiles in milliseconds, its mean
+        SQL time, DataFrame time, VM steps and rows, and its plan; the most
+        expensive queries come first.
+        """
+        with self._lock:
+            runs = dict((key, list(values))
+                        for key, values in self._runs.items())
+            plans = dict(self._plans)
+        rows = []
+        for key, values in runs.items():
+            wall = np.array([run['wall_ms'] for run in values])
+            rows.append({
+                'query': key, 'calls': len(values), 'total_ms': wall.sum(),
+                'p50_ms': np.percentile(wall, 50),
+                'p90_ms': np.percentile(wall, 90),
+                'p99_ms': np.percentile(wall, 99), 'max_ms': wall.max(),
+                'sql_ms': np.mean([run['sql_ms'] for run in values]),
+                'frame_ms': np.mean([run['frame_ms'] for run in values]),
+                'steps': np.mean([run['steps'] for run in values]),
+                'rows': np.mean([run['rows'] for run in values]),
+                'plan': '; '.join(plans.get(key, ()))})
+        columns = ['query', 'calls', 'total_ms', 'p50_ms', 'p90_ms', 'p99_ms',
+                   'max_ms', 'sql_ms', 'frame_ms', 'steps', 'rows', 'plan']
+        return pd.DataFrame(rows, columns=columns).sort_values(
+            'total_ms', ascending=False).reset_index(drop=True)
+
+    def reset(self):
+        with self._lock:
+            self._runs.clear()
+            self._plans.clear()
+
+
+def enable(path=hubway.DATABASE, **options):
+    """
+    Starts profiling the queries run_query sends to the database at path
+    and returns the Profiler; options are passed on to it.
+    """
+    profiler = Profiler(**options)
+    hubway.get_service(path).profiler = profiler
+    return profiler
+
+
+def disable(path=hubway.DATABASE):
+    """
+    Stops profiling and returns the Profiler that was in use, if any.
+    """
+    service = hubway.get_service(path)
+    profiler, service.profiler = service.profiler, None
+    return profiler
+
+
+def main(argv=None):
+    import hubway_indexes
+    parser = argparse.ArgumentParser(
+        description="Profile the queries of a notebook against hubway.db.")
+    parser.add_argument('notebooks', nargs='+')
+    parser.add_argument('--db', default=hubway.DATABASE)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--slow-ms', type=float, default=100.0)
+    parser.add_argument('--log', default=LOG_NAME)
+    args = parser.parse_args(argv)
+    profiler = enable(args.db, slow_ms=args.slow_ms, log=args.log)
+    service = hubway.get_service(args.db)
+    queries = [query for notebook in args.notebooks
+               for query in hubway_indexes.notebook_queries(notebook)]
+    for _ in range(args.repeat):
+        for query in queries:
+            service.clear()
+            service.run_query(query)
+    report = profiler.report()
+    with pd.option_context('display.max_colwidth', 60, 'display.width', 200):
+        print(report.drop(columns='plan').to_string(
+            float_format='{0:.2f}'.format))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
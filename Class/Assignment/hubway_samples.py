@@ -0,0 +1,237 @@
+'''
+Approximate answers for exploratory COUNT, SUM and AVG queries over the
+Hubway trips, from stratified samples of trips kept in hubway.db at 0.1%,
+1% and 10%:
+
+    import hubway
+    hubway.run_query('SELECT AVG(duration) FROM trips '
+                     'WHERE (2020 - birth_date) > 30', approximate=0.01)
+
+returns, for every aggregate, the estimate, its standard error and a 95%
+confidence interval, computed from the 1% sample instead of every trip.
+
+The samples are stratified by subscription type, gender and year: each
+stratum contributes the same fraction of its trips (at least one), picked
+by a fixed hash of the rowid, so the smaller samples are subsets of the
+larger ones. Building them takes a write lock and a full pass over trips,
+so it is never done on the query path; build them (again, after changing
+trips) with
+
+    python hubway_samples.py
+
+Until the samples have been built, or once trips have been added since,
+approximate queries warn and are answered exactly from trips instead (a
+full scan), with a standard error of 0. Rates other than RATES are
+rejected.
+
+Supported queries are SELECT lists of COUNT(*), COUNT(column),
+SUM(column) and AVG(column), each optionally with an alias, FROM trips with
+an optional WHERE.
+'''
+
+import argparse
+import re
+import sqlite3
+import statistics
+import sys
+import threading
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import hubway
+
+RATES = (0.001, 0.01, 0.1)
+STRATA = ("IFNULL(sub_type, '')", "IFNULL(gender, '')",
+          "IFNULL(substr(start_date, 1, 4), '')")
+STATE = 'sample_state'
+
+_QUERY = re.compile(r'SELECT\s+(?P<select>.+?)\s+FROM\s+trips'
+                    r'(?:\s+WHERE\s+(?P<where>.+))?\Z',
+                    re.IGNORECASE | re.DOTALL)
+_AGGREGATE = re.compile(r'\s*(?P<function>COUNT|SUM|AVG)\s*\(\s*'
+                        r'(?P<column>\*|\w+)\s*\)'
+                        r'(?:\s+(?:AS\s+)?(?P<alias>"[^"]*"|\w+))?\s*\Z',
+                        re.IGNORECASE)
+
+_build_lock = threading.Lock()
+
+
+def table_name(rate):
+    return 'trips_sample_{0}'.format(('%g' % (rate * 100)).replace('.', '_'))
+
+
+def build(path=hubway.DATABASE, rates=RATES):
+    """
+    (Re)builds the sample tables for the rates, recording the trips they
+    were drawn from.
+    """
+    stratum = " || '|' || ".join(STRATA)
+    with _build_lock:
+        connection = sqlite3.connect(path, isolation_level=None)
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS {0} (rate REAL PRIMARY KEY, '
+                    'mark INTEGER)'.format(STATE))
+                mark = connection.execute(
+                    'SELECT MAX(rowid) FROM trips').fetchone()[0]
+                for rate in rates:
+                    name = table_name(rate)
+                    connection.execute('DROP TABLE IF EXISTS ' + name)
+                    # Every stratum keeps ceil(rate * size) trips, those with
+                    # the lowest hash of their rowid.
+                    connection.execute(
+                        'CREATE TABLE {0} AS SELECT * FROM ('
+                        'SELECT trips.*, {1} AS stratum, '
+                        'COUNT(*) OVER (PARTITION BY {1}) AS population, '
+                        'ROW_NUMBER() OVER (PARTITION BY {1} ORDER BY '
+                        '(rowid * 2654435761) % 4294967296, rowid) AS rank '
+                        'FROM trips) WHERE rank <= MAX(1, '
+                        'CAST(population * ? + 0.999999 AS INTEGER))'.format(
+                            name, stratum), (rate,))
+                    connection.execute(
+                        'INSERT OR REPLACE INTO {0} VALUES (?, ?)'.format(
+                            STATE), (rate, mark))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        finally:
+            connection.close()
+
+
+def fresh(rate, path=hubway.DATABASE):
+    """
+    Returns whether the sample for rate has been built and no trips have
+    been added since it was drawn. (Only the highest rowid is compared,
+    since counting trips would cost a full scan; rebuild after deleting
+    trips.)
+    """
+    with hubway.get_service(path).connection() as connection:
+        current = connection.execute('SELECT MAX(rowid) FROM trips').fetchone()
+        try:
+            recorded = connection.execute(
+                'SELECT mark FROM {0} WHERE rate = ?'.format(STATE),
+                (rate,)).fetchone()
+        except sqlite3.OperationalError:
+            recorded = None
+    return recorded is not None and recorded[0] == current[0]
+
+
+def _parse(query):
+    """
+    Returns ([(name, function, column)], where) for a supported query.
+    """
+    match = _QUERY.match(hubway._normalize(query))
+    if not match:
+        raise ValueError('Approximate queries must be SELECT ... FROM trips '
+                         '[WHERE ...]: {0!r}'.format(query))
+    aggregates = []
+    for item in match.group('select').split(','):
+        aggregate = _AGGREGATE.match(item)
+        if not aggregate:
+            raise ValueError('Only COUNT, SUM and AVG can be approximated: '
+                             '{0!r}'.format(item.strip()))
+        function = aggregate.group('function').upper()
+        column = aggregate.group('column')
+        if column == '*' and function != 'COUNT':
+            raise ValueError('Only COUNT can take *: {0!r}'.format(item))
+        name = (aggregate.group('alias') or item.strip()).strip('"')
+        aggregates.append((name, function, column))
+    return aggregates, match.group('where')
+
+
+def estimate(query, params=None, rate=0.01, confidence=0.95,
+             path=hubway.DATABASE):
+    """
+    Returns a DataFrame with a row per aggregate of query: the estimate,
+    its standard error and the confidence interval, from the sample at
+    rate, along with the number of sampled trips that matched. If that
+    sample is missing or stale, the values are exact, from every trip, and
+    a warning says so.
+    """
+    if rate not in RATES:
+        raise ValueError('The sample rate must be one of {0}, not {1!r}'
+                         .format(', '.join(map(str, RATES)), rate))
+    aggregates, where = _parse(query)
+    exact = not fresh(rate, path)
+    if exact:
+        warnings.warn('The {0:g}% sample of trips is missing or out of date, '
+                      'so the query scans every trip; build the samples with '
+                      '"python hubway_samples.py"'.format(rate * 100),
+                      stacklevel=3)
+    # Exactly, all of trips is one stratum sampled in full, so the weights
+    # are 1 and the variances 0.
+    source = ("(SELECT *, '' AS stratum, NULL AS population FROM trips)"
+              if exact else table_name(rate))
+    values = sorted(set(column for _, _, column in aggregates
+                        if column != '*'))
+    parts = ['stratum', 'MAX(population) AS population',
+             'COUNT(*) AS sampled']
+    for index, column in enumerate(['*'] + values):
+        value = '1' if column == '*' else '"{0}"'.format(column)
+        condition = 'hit' if column == '*' else \
+            'hit AND "{0}" IS NOT NULL'.format(column)
+        parts += ['SUM(CASE WHEN {0} THEN 1 ELSE 0 END) AS c{1}'.format(
+                      condition, index),
+                  'TOTAL(CASE WHEN {0} THEN {1} END) AS s{2}'.format(
+                      condition, value, index),
+                  'TOTAL(CASE WHEN {0} THEN {1} * {1} END) AS q{2}'.format(
+                      condition, value, index)]
+    strata = hubway.run_query(
+        'SELECT {0} FROM (SELECT *, CASE WHEN {1} THEN 1 ELSE 0 END AS hit '
+        'FROM {2} AS trips) GROUP BY stratum'.format(
+            ', '.join(parts), where or '1', source), params, path)
+    sampled = strata['sampled'].to_numpy(dtype=float)
+    population = sampled if exact else \
+        strata['population'].to_numpy(dtype=float)
+    weight = population / sampled
+    # Finite population correction over the sample size, per stratum;
+    # strata with one sampled trip give no variance estimate.
+    scale = np.where(sampled > 1, population ** 2 * (1 - sampled / population)
+                     / sampled / np.maximum(sampled - 1, 1), 0.0)
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    rows = []
+    for name, function, column in aggregates:
+        index = 0 if column == '*' else values.index(column) + 1
+        count = strata['c{0}'.format(index)].to_numpy(dtype=float)
+        total = strata['s{0}'.format(index)].to_numpy(dtype=float)
+        squares = strata['q{0}'.format(index)].to_numpy(dtype=float)
+        if function == 'COUNT':
+            value = np.sum(weight * count)
+            variance = np.sum(scale * (count - count ** 2 / sampled))
+        elif function == 'SUM':
+            value = np.sum(weight * total)
+            variance = np.sum(scale * (squares - total ** 2 / sampled))
+        else:
+            matched = np.sum(weight * count)
+            value = np.sum(weight * total) / matched if matched else np.nan
+            # Linearized variance of the ratio of two estimated totals.
+            residuals = total - value * count
+            residual_squares = squares - 2 * value * total + value ** 2 * count
+            variance = (np.sum(scale * (residual_squares
+                                        - residuals ** 2 / sampled))
+                        / matched ** 2) if matched else np.nan
+        error = float(np.sqrt(max(variance, 0.0)))
+        rows.append({'aggregate': name, 'estimate': value, 'stderr': error,
+                     'low': value - z * error, 'high': value + z * error,
+                     'sampled': int(strata['c{0}'.format(index)].sum())})
+    return pd.DataFrame(rows).set_index('aggregate')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build the stratified trip samples in hubway.db.")
+    parser.add_argument('--db', default=hubway.DATABASE)
+    args = parser.parse_args(argv)
+    build(args.db)
+    for rate in RATES:
+        print('{0}: {1:g}% of trips'.format(table_name(rate), rate * 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
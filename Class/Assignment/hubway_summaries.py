@@ -0,0 +1,253 @@
+'''
+Materialized summaries of the Hubway trips for the notebooks' heaviest
+GROUP BY queries:
+
+* summary_start_stations  trips per start station
+* summary_round_trips     round trips per station and subscription type
+* summary_bikes           trips and total duration per bike
+* summary_municipalities  trips and total duration per municipality, for
+                          trips that start and end in the same one
+
+Build them once (this writes to hubway.db):
+
+    python hubway_summaries.py
+
+From then on hubway.run_query answers the matching notebook queries from
+the summaries instead of scanning trips, for example
+
+    SELECT bike_number as "Bike Number", COUNT(*) AS "Number of Trips"
+    FROM trips GROUP BY bike_number ORDER BY COUNT(*) DESC LIMIT 1
+
+The results are the same, except that rows which tie on the ORDER BY may
+come out in a different order (and so be cut differently by a LIMIT).
+The summaries remember the highest trips rowid they include. Queries are
+only rewritten while the summaries include every trip; after trips have
+been added they run against trips again until the summaries are refreshed
+(reading never writes to hubway.db). Running hubway_summaries.py again
+folds in only the trips added since. Deleting or updating trips, or
+editing stations, needs a full rebuild: "python hubway_summaries.py --full".
+'''
+
+import argparse
+import re
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+import hubway
+
+# name -> (key columns, measure columns, query for the trips in a rowid
+# range, with the keys first and the measures after them)
+SUMMARIES = OrderedDict([
+    ('summary_start_stations', (
+        ('start_station',), ('trips',),
+        'SELECT start_station, COUNT(*) FROM trips '
+        'WHERE rowid > ? AND rowid <= ? GROUP BY start_station')),
+    ('summary_round_trips', (
+        ('station', 'sub_type'), ('trips',),
+        'SELECT start_station, sub_type, COUNT(*) FROM trips '
+        'WHERE rowid > ? AND rowid <= ? AND start_station = end_station '
+        'GROUP BY start_station, sub_type')),
+    ('summary_bikes', (
+        ('bike_number',), ('trips', 'duration'),
+        'SELECT bike_number, COUNT(*), SUM(duration) FROM trips '
+        'WHERE rowid > ? AND rowid <= ? GROUP BY bike_number')),
+    ('summary_municipalities', (
+        ('municipality',), ('timed', 'duration'),
+        'SELECT start.municipality, COUNT(trips.duration), '
+        'SUM(trips.duration) FROM trips '
+        'INNER JOIN stations AS start ON trips.start_station = start.id '
+        'INNER JOIN stations AS end ON trips.end_station = end.id '
+        'WHERE trips.rowid > ? AND trips.rowid <= ? '
+        'AND start.municipality = end.municipality '
+        'GROUP BY start.municipality')),
+])
+
+STATE = 'summary_state'
+
+# (query, equivalent query on a summary). In the query, spaces stand for
+# any whitespace and {limit}, {columns} and {hours} for the optional parts
+# the notebooks vary; the replacement repeats whatever they matched.
+REWRITES = [
+    ('SELECT stations.station AS "Station", COUNT(*) AS "Count" FROM trips '
+     'INNER JOIN stations ON trips.start_station = stations.id '
+     'GROUP BY stations.station ORDER BY COUNT(*) DESC{limit}',
+     'SELECT stations.station AS "Station", SUM(s.trips) AS "Count" '
+     'FROM summary_start_stations AS s '
+     'INNER JOIN stations ON s.start_station = stations.id '
+     'GROUP BY stations.station ORDER BY SUM(s.trips) DESC{limit}'),
+    ('SELECT stations.station AS "Station", COUNT(*) AS "Count"{columns} '
+     'FROM trips INNER JOIN stations ON trips.start_station = stations.id '
+     'WHERE trips.start_station = trips.end_station '
+     'GROUP BY stations.station ORDER BY COUNT(*) DESC{limit}',
+     'SELECT stations.station AS "Station", SUM(s.trips) AS "Count"{columns} '
+     'FROM summary_round_trips AS s '
+     'INNER JOIN stations ON s.station = stations.id '
+     'GROUP BY stations.station ORDER BY SUM(s.trips) DESC{limit}'),
+    ('SELECT stations.station AS "Station", trips.sub_type , '
+     'COUNT(*) AS "Count" FROM trips '
+     'INNER JOIN stations ON trips.start_station = stations.id '
+     'WHERE trips.start_station = trips.end_station '
+     'GROUP BY stations.station , trips.sub_type '
+     'ORDER BY COUNT(*) DESC{limit}',
+     'SELECT stations.station AS "Station", s.sub_type, '
+     'SUM(s.trips) AS "Count" FROM summary_round_trips AS s '
+     'INNER JOIN stations ON s.station = stations.id '
+     'GROUP BY stations.station, s.sub_type '
+     'ORDER BY SUM(s.trips) DESC{limit}'),
+    ('SELECT bike_number AS "Bike Number", COUNT(*) AS "Number of Trips"'
+     '{hours} FROM trips GROUP BY bike_number ORDER BY COUNT(*) DESC{limit}',
+     'SELECT bike_number AS "Bike Number", SUM(trips) AS "Number of Trips"'
+     '{hours} FROM summary_bikes GROUP BY bike_number '
+     'ORDER BY SUM(trips) DESC{limit}'),
+    ('SELECT start.municipality AS "Municipality", '
+     'AVG(trips.duration) AS "Duration" FROM trips '
+     'INNER JOIN stations AS start ON trips.start_station = start.id '
+     'INNER JOIN stations AS end ON trips.end_station = end.id '
+     'WHERE start.municipality = end.municipality '
+     'GROUP BY start.municipality ORDER BY AVG(trips.duration) DESC{limit}',
+     'SELECT municipality AS "Municipality", '
+     'SUM(duration) * 1.0 / SUM(timed) AS "Duration" '
+     'FROM summary_municipalities GROUP BY municipality '
+     'ORDER BY SUM(duration) * 1.0 / SUM(timed) DESC{limit}'),
+]
+
+_PARTS = {'limit': r'(?P<limit>\s+LIMIT\s+\d+)?',
+          'columns': r'(?P<columns>(?:\s*,\s*stations\.\w+)*)',
+          'hours': r'(?P<hours>\s*,\s*SUM\(duration\)\s*/\s*3600\s+AS\s+'
+                   r'"Total Ridden Time \(Hrs\)")?'}
+
+
+def _compile(query):
+    pattern = r'\s*'.join(re.escape(word) for word in query.split(' '))
+    for name, part in _PARTS.items():
+        pattern = pattern.replace(re.escape('{' + name + '}'), part)
+    return re.compile(pattern + r'\Z', re.IGNORECASE)
+
+
+_REWRITES = [(_compile(query), replacement)
+             for query, replacement in REWRITES]
+
+_refresh_lock = threading.Lock()
+
+
+def _create(connection):
+    for name, (keys, measures, _) in SUMMARIES.items():
+        connection.execute('CREATE TABLE IF NOT EXISTS {0} ({1})'.format(
+            name, ', '.join(keys + measures)))
+    connection.execute('CREATE TABLE IF NOT EXISTS {0} '
+                       '(name TEXT PRIMARY KEY, mark INTEGER)'.format(STATE))
+
+
+def _fold(connection, name, low, high):
+    """
+    Adds the trips with rowids in (low, high] to the summary, leaving one
+    row per key.
+    """
+    keys, measures, query = SUMMARIES[name]
+    columns = ', '.join(keys + measures)
+    connection.execute('INSERT INTO {0} ({1}) {2}'.format(name, columns, query),
+                       (low, high))
+    if low:
+        connection.execute(
+            'CREATE TEMP TABLE folded AS SELECT {0}, {1} FROM {2} '
+            'GROUP BY {0}'.format(', '.join(keys), ', '.join(
+                'SUM({0})'.format(measure) for measure in measures), name))
+        connection.execute('DELETE FROM {0}'.format(name))
+        connection.execute('INSERT INTO {0} ({1}) SELECT * FROM folded'
+                           .format(name, columns))
+        connection.execute('DROP TABLE folded')
+
+
+def refresh(path=hubway.DATABASE, full=False):
+    """
+    Brings every summary up to date with trips, creating the tables if
+    needed, and returns {name: number of trip rowids folded in}. With full,
+    or when trips have been deleted past a summary's mark, the summary is
+    rebuilt from scratch.
+    """
+    with _refresh_lock:
+        connection = sqlite3.connect(path, isolation_level=None)
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                _create(connection)
+                high = connection.execute(
+                    'SELECT MAX(rowid) FROM trips').fetchone()[0] or 0
+                marks = dict(connection.execute(
+                    'SELECT name, mark FROM {0}'.format(STATE)))
+                folded = {}
+                for name in SUMMARIES:
+                    low = marks.get(name, 0)
+                    if full or low > high:
+                        connection.execute('DELETE FROM {0}'.format(name))
+                        low = 0
+                    if low < high:
+                        _fold(connection, name, low, high)
+                    connection.execute(
+                        'INSERT OR REPLACE INTO {0} VALUES (?, ?)'.format(STATE),
+                        (name, high))
+                    folded[name] = high - low
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        finally:
+            connection.close()
+    return folded
+
+
+def _current(path):
+    """
+    Tells whether the summaries exist and include every trip.
+    """
+    with hubway.get_service(path).connection() as connection:
+        try:
+            marks = connection.execute(
+                'SELECT MIN(mark), COUNT(*) FROM {0}'.format(STATE)).fetchone()
+        except sqlite3.OperationalError:
+            return False
+        high = connection.execute(
+            'SELECT MAX(rowid) FROM trips').fetchone()[0] or 0
+    return marks == (high, len(SUMMARIES))
+
+
+def rewrite(query, path=hubway.DATABASE):
+    """
+    Returns the summary query equivalent to the normalized query, or None
+    if there is none or the summaries are missing or out of date.
+    """
+    for pattern, replacement in _REWRITES:
+        match = pattern.match(query)
+        if match:
+            if not _current(path):
+                return None
+            parts = dict((name, value or '')
+                         for name, value in match.groupdict().items())
+            return replacement.format(**parts)
+    return None
+
+
+def rewriter(path=hubway.DATABASE):
+    """
+    Returns rewrite bound to the database at path, for
+    QueryService.add_rewrite.
+    """
+    return lambda query: rewrite(query, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build or update the trip summaries in hubway.db.")
+    parser.add_argument('--db', default=hubway.DATABASE)
+    parser.add_argument('--full', action='store_true',
+                        help="rebuild every summary from scratch")
+    args = parser.parse_args(argv)
+    for name, count in refresh(args.db, args.full).items():
+        print('{0}: {1} new trips'.format(name, count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
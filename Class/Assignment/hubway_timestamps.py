@@ -0,0 +1,234 @@
+'''
+Integer timestamps for the Hubway trips. start_date and end_date are text
+("2012-07-28 10:12:00"), so a filter such as
+
+    WHERE start_date > "2012-01-01" and start_date < "2013-01-01"
+
+compares strings row by row, and every time-bucketed analysis re-parses
+them. The migration adds start_ts and end_ts columns holding the same
+times as seconds since 1970-01-01 (taking the stored times as they are,
+without a time zone), indexes them, and keeps them up to date with
+triggers:
+
+    python hubway_timestamps.py             # migrates hubway.db
+
+rewrite() then moves date-range predicates onto the new columns, and
+rollup() counts trips per hour, day, month or year with an index range
+scan:
+
+    import hubway_timestamps
+    hubway_timestamps.run_query(
+        'SELECT count(*) FROM trips '
+        'WHERE start_date > "2012-01-01" and start_date < "2013-01-01"')
+    hubway_timestamps.rollup('day', '2012-06-01', '2012-07-01')
+'''
+
+import argparse
+import calendar
+import datetime
+import re
+import sqlite3
+import sys
+import time
+
+import pandas as pd
+
+import hubway
+
+COLUMNS = {'start_date': 'start_ts', 'end_date': 'end_ts'}
+
+# Seconds per bucket for the rollups that are plain arithmetic; months and
+# years go through strftime.
+UNITS = {'hour': 3600, 'day': 86400, 'month': '%Y-%m-01', 'year': '%Y-01-01'}
+
+_EPOCH = "CAST(strftime('%s', {0}) AS INTEGER)"
+
+_LITERAL = r'''(?:"([^"]*)"|'([^']*)')'''
+_COMPARISON = re.compile(
+    r'(?<![\w.])((?:\w+\.)?)(start_date|end_date)\s*(>=|<=|>|<)\s*'
+    + _LITERAL, re.IGNORECASE)
+_BETWEEN = re.compile(
+    r'(?<![\w.])((?:\w+\.)?)(start_date|end_date)\s+BETWEEN\s+' + _LITERAL
+    + r'\s+AND\s+' + _LITERAL, re.IGNORECASE)
+
+
+def migrate(path=hubway.DATABASE):
+    """
+    Adds and fills start_ts and end_ts, indexes them and installs the
+    triggers that keep them in step with start_date and end_date. Safe to
+    run again: it only fills the rows that are missing a timestamp.
+    """
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            existing = [row[1] for row in connection.execute(
+                'PRAGMA table_info(trips)')]
+            for text, ts in COLUMNS.items():
+                if ts not in existing:
+                    connection.execute(
+                        'ALTER TABLE trips ADD COLUMN {0} INTEGER'.format(ts))
+                connection.execute(
+                    'UPDATE trips SET {0} = {1} WHERE {0} IS NULL AND {2} '
+                    'IS NOT NULL'.format(ts, _EPOCH.format(text), text))
+                connection.execute('CREATE INDEX IF NOT EXISTS trips_{0} ON '
+                                   'trips ({0})'.format(ts))
+            assignments = ', '.join('{0} = {1}'.format(
+                ts, _EPOCH.format('NEW.' + text))
+                for text, ts in COLUMNS.items())
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS trips_ts_insert AFTER INSERT '
+                'ON trips BEGIN UPDATE trips SET {0} WHERE rowid = NEW.rowid; '
+                'END'.format(assignments))
+            connection.execute(
+                'CREATE TRIGGER IF NOT EXISTS trips_ts_update AFTER UPDATE OF '
+                'start_date, end_date ON trips BEGIN UPDATE trips SET {0} '
+                'WHERE rowid = NEW.rowid; END'.format(assignments))
+            connection.execute('ANALYZE trips')
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+    finally:
+        connection.close()
+
+
+def epoch(value):
+    """
+    Returns the seconds since 1970-01-01 of a date or time given as text,
+    datetime or Timestamp, without a time zone.
+    """
+    timestamp = pd.Timestamp(value)
+    return calendar.timegm(timestamp.timetuple())
+
+
+# The stored format, and the prefixes of it that end with a whole field.
+_FORMAT = '%Y-%m-%d %H:%M:%S'
+_PADDING = '0000-01-01 00:00:00'
+_PREFIX = re.compile(r'\d{4}(-\d{2}(-\d{2}( \d{2}(:\d{2}(:\d{2})?)?)?)?)?\Z')
+
+
+def _earliest(literal):
+    """
+    Returns the earliest stored time that starts with literal, a prefix of
+    "YYYY-MM-DD HH:MM:SS" ending with a whole field, as a datetime; raises
+    ValueError for any other literal.
+    """
+    if not _PREFIX.match(literal):
+        raise ValueError('{0!r} is not a prefix of {1}'.format(literal,
+                                                                _FORMAT))
+    return datetime.datetime.strptime(
+        literal + _PADDING[len(literal):], _FORMAT)
+
+
+def _bound(column, operator, literal):
+    """
+    Returns the start_ts/end_ts condition equivalent to comparing the text
+    column with literal. A shorter prefix such as "2012-03-01" sorts before
+    every stored time that starts with it, so "> prefix" also takes its
+    earliest time and "<= prefix" takes none of it.
+    """
+    seconds = calendar.timegm(_earliest(literal).timetuple())
+    if len(literal) < len(_PADDING):
+        operator = {'>': '>=', '>=': '>=', '<': '<', '<=': '<'}[operator]
+    return '{0} {1} {2}'.format(column, operator, seconds)
+
+
+def rewrite(query):
+    """
+    Returns query with every comparison or BETWEEN of start_date or end_date
+    against a literal moved onto start_ts or end_ts. Only literals written
+    like the stored times ("2012-03-01 10:00:00", or a prefix such as
+    "2012-03-01 10:00" or "2012-03") are moved; others, such as
+    "2012-03-01T10:00", are left alone.
+    """
+    def comparison(match):
+        prefix, column, operator = match.group(1), match.group(2).lower(), \
+            match.group(3)
+        literal = match.group(4) if match.group(4) is not None \
+            else match.group(5)
+        try:
+            return _bound(prefix + COLUMNS[column], operator, literal)
+        except ValueError:
+            return match.group(0)
+
+    def between(match):
+        prefix, column = match.group(1), match.group(2).lower()
+        low = match.group(3) if match.group(3) is not None else match.group(4)
+        high = match.group(5) if match.group(5) is not None \
+            else match.group(6)
+        try:
+            return '({0} AND {1})'.format(
+                _bound(prefix + COLUMNS[column], '>=', low),
+                _bound(prefix + COLUMNS[column], '<=', high))
+        except ValueError:
+            return match.group(0)
+    return _COMPARISON.sub(comparison, _BETWEEN.sub(between, query))
+
+
+def migrated(path=hubway.DATABASE):
+    """
+    Tells whether trips has the start_ts and end_ts columns of migrate().
+    """
+    with hubway.get_service(path).connection() as connection:
+        existing = [row[1] for row in connection.execute(
+            'PRAGMA table_info(trips)')]
+    return all(ts in existing for ts in COLUMNS.values())
+
+
+def run_query(query, params=None, path=hubway.DATABASE):
+    """
+    Runs query through hubway.run_query with its date ranges rewritten, or
+    as it is if the database has not been migrated.
+    """
+    if migrated(path):
+        query = rewrite(query)
+    return hubway.run_query(query, params, path)
+
+
+def rollup(unit='day', start=None, end=None, column='start_ts',
+           path=hubway.DATABASE):
+    """
+    Returns the number of trips and their mean duration per hour, day,
+    month or year of start_ts (or end_ts), for the trips in [start, end),
+    as a DataFrame indexed by the start of each bucket.
+    """
+    if unit not in UNITS:
+        raise ValueError('Unknown unit {0!r}; expected one of {1}'.format(
+            unit, ', '.join(UNITS)))
+    if column not in COLUMNS.values():
+        raise ValueError('Unknown column {0!r}'.format(column))
+    if isinstance(UNITS[unit], int):
+        bucket = '{0} - {0} % {1}'.format(column, UNITS[unit])
+    else:
+        bucket = ("CAST(strftime('%s', strftime('{0}', {1}, 'unixepoch')) "
+                  "AS INTEGER)".format(UNITS[unit], column))
+    conditions, params = ['{0} IS NOT NULL'.format(column)], []
+    if start is not None:
+        conditions.append('{0} >= ?'.format(column))
+        params.append(epoch(start))
+    if end is not None:
+        conditions.append('{0} < ?'.format(column))
+        params.append(epoch(end))
+    result = hubway.run_query(
+        'SELECT {0} AS bucket, COUNT(*) AS trips, AVG(duration) AS duration '
+        'FROM trips WHERE {1} GROUP BY bucket ORDER BY bucket'.format(
+            bucket, ' AND '.join(conditions)), params, path)
+    result['bucket'] = pd.to_datetime(result['bucket'], unit='s')
+    return result.set_index('bucket')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Add indexed epoch timestamps to hubway.db's trips.")
+    parser.add_argument('--db', default=hubway.DATABASE)
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    migrate(args.db)
+    print('migrated {0} in {1:.2f} s'.format(args.db,
+                                             time.perf_counter() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+'''
+folium layers built from a whole DataFrame at once. The mapping notebooks
+add one folium.Marker per row,
+
+    for name, row in df.iterrows():
+        folium.Marker([row["lat"], row["lng"]],
+                      popup=row["station"]).add_to(marker_cluster)
+
+which is slow past a few thousand rows and writes a separate JavaScript
+object per marker into the HTML. markers() turns the columns into one
+compact array of rows in a single vectorized pass and emits it as one
+layer: a FastMarkerCluster (one JavaScript loop draws every marker) or,
+with cluster=False, a single GeoJSON layer of circle markers:
+
+    import map_layers
+    map_layers.markers(df, popup='station').add_to(stops_map)
+    map_layers.markers(metro, lat='LAT', lng='LONG', popup='STATION',
+                       tooltip='{LINE} Line: {STATION}', category='LINE',
+                       cluster=False).add_to(m)
+    map_layers.heatmap(df, weight='Count').add_to(stops_heatmap)
+
+zoom_heatmap() draws the pre-binned levels of a hubway_grid.Grid, shipping
+every zoom level's non-empty cells and showing the nearest level's as the
+map zooms.
+
+Popups and tooltips are a column name or a template of column names such
+as '{LINE} Line: {STATION}'. Markers are colored from a column of colors
+(color=) or by category (category=, with an optional colors= mapping from
+category to color; categories without one take the next color of PALETTE).
+The PALETTE names are awesome-marker colors, not all of them valid CSS, so
+the circle markers of cluster=False draw them in the CSS color of the same
+name in MARKER_CSS; other colors are used as they are. To draw every
+marker as its own pin, keep cluster=True and turn clustering off at the
+map's zoom levels with disable_clustering_at_zoom=1.
+'''
+
+import json
+import string
+
+import folium
+import numpy as np
+import pandas as pd
+from folium import plugins
+from folium.template import Template
+
+# The marker colors folium.Icon (Leaflet.awesome-markers) accepts.
+PALETTE = ('blue', 'red', 'green', 'purple', 'orange', 'darkred', 'cadetblue',
+           'darkgreen', 'darkblue', 'pink', 'lightblue', 'lightgreen', 'gray',
+           'black', 'beige', 'darkpurple', 'lightred', 'lightgray', 'white')
+
+# The fill of every PALETTE color in Leaflet.awesome-markers' sprites.
+MARKER_CSS = {'red': '#d63e2a', 'darkred': '#a23336', 'lightred': '#ff8e7f',
+              'orange': '#f69730', 'beige': '#ffcb92', 'green': '#72b026',
+              'darkgreen': '#728224', 'lightgreen': '#bbf970',
+              'blue': '#38aadd', 'darkblue': '#0067a3', 'lightblue': '#8adaff',
+              'purple': '#d252b9', 'darkpurple': '#5b396b', 'pink': '#ff91ea',
+              'cadetblue': '#436978', 'white': '#fbfbfb', 'gray': '#575757',
+              'lightgray': '#a3a3a3', 'black': '#303030'}
+
+# Draws row [lat, lng, popup, tooltip, color] of a FastMarkerCluster.
+_CALLBACK = '''function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.setIcon(row[4] === null ? L.AwesomeMarkers.icon() :
+        L.AwesomeMarkers.icon({markerColor: row[4], icon: %s,
+                               prefix: 'glyphicon'}));
+    if (row[2] !== null) { marker.bindPopup(row[2]); }
+    if (row[3] !== null) { marker.bindTooltip(row[3]); }
+    return marker;
+}'''
+
+
+def _strings(values):
+    """
+    Returns a column as text, with '' for NULLs.
+    """
+    return values.astype(object).where(values.notna(), '').astype(str)
+
+
+def text(frame, spec):
+    """
+    Returns a Series of text per row from a column name or a template of
+    column names such as '{LINE} Line: {STATION}' (format specs such as
+    '{Count:,}' are allowed), or None if spec is None.
+    """
+    if spec is None:
+        return None
+    if spec in frame.columns:
+        return _strings(frame[spec])
+    result = pd.Series('', index=frame.index, dtype=object)
+    for literal, field, format_spec, _ in string.Formatter().parse(spec):
+        result = result + literal
+        if field is None:
+            continue
+        if field not in frame.columns:
+            raise KeyError('No column {0!r} for {1!r}'.format(field, spec))
+        values = frame[field]
+        if format_spec:
+            values = values.map(('{0:' + format_spec + '}').format,
+                                na_action='ignore')
+        result = result + _strings(values)
+    return result
+
+
+def colors_for(frame, color=None, category=None, colors=None):
+    """
+    Returns a Series with the color of every row, or None: color is a
+    column of colors or a single color; otherwise every value of the
+    category column gets colors[value], or the next unused PALETTE color.
+    """
+    if color is not None:
+        if color in frame.columns:
+            return frame[color].astype(object).where(frame[color].notna(),
+                                                     None)
+        return pd.Series(color, index=frame.index, dtype=object)
+    if category is None:
+        return None
+    mapping = dict(colors or {})
+    unused = [value for value in PALETTE if value not in mapping.values()]
+    for position, value in enumerate(sorted(
+            set(frame[category].dropna().unique()) - set(mapping), key=str)):
+        mapping[value] = (unused or PALETTE)[position % len(unused or PALETTE)]
+    return frame[category].map(mapping).astype(object).where(
+        frame[category].notna(), None)
+
+
+def css_color(color):
+    """
+    Returns the CSS color of a marker color: the MARKER_CSS color of a
+    PALETTE name, PALETTE[0]'s for a missing one, and any other color
+    unchanged.
+    """
+    if color is None or pd.isna(color):
+        color = PALETTE[0]
+    return MARKER_CSS.get(color, color)
+
+
+def _located(frame, lat, lng):
+    return frame[frame[lat].notna() & frame[lng].notna()]
+
+
+def _columns(frame, lat, lng, popup, tooltip, color, category, colors):
+    """
+    Returns the located rows' [lat, lng, popup, tooltip, color] as a
+    DataFrame, with None where there is no value.
+    """
+    frame = _located(frame, lat, lng)
+    columns = {'lat': frame[lat].astype(float), 'lng': frame[lng].astype(float)}
+    for name, values in (('popup', text(frame, popup)),
+                         ('tooltip', text(frame, tooltip)),
+                         ('color', colors_for(frame, color, category,
+                                              colors))):
+        # pandas may hold a missing value as NaN even in an object column,
+        # so rows() turns them into None on the way out.
+        columns[name] = pd.Series(None, index=frame.index, dtype=object) \
+            if values is None else values
+    return pd.DataFrame(columns, index=frame.index)
+
+
+def rows(frame):
+    """
+    Returns the rows of frame as lists, with None (null in JavaScript)
+    wherever a value is missing.
+    """
+    values = frame.to_numpy(dtype=object)
+    return np.where(pd.isna(values), None, values).tolist()
+
+
+def features(frame, lat='lat', lng='lng', properties=None):
+    """
+    Returns a GeoJSON FeatureCollection (a dict) of a point per located row,
+    with the given columns (all the others by default) as properties.
+    """
+    frame = _located(frame, lat, lng)
+    if properties is None:
+        properties = [column for column in frame.columns
+                      if column not in (lat, lng)]
+    values = frame[properties].astype(object)
+    records = values.where(values.notna(), None).to_dict('records')
+    points = frame[[lng, lat]].astype(float).to_numpy().tolist()
+    return {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': record,
+         'geometry': {'type': 'Point', 'coordinates': point}}
+        for record, point in zip(records, points)]}
+
+
+def markers(frame, lat='lat', lng='lng', popup=None, tooltip=None, color=None,
+            category=None, colors=None, cluster=True, icon='info-sign',
+            radius=6, name=None, **options):
+    """
+    Returns one layer with a marker per row of frame that has a location:
+    a FastMarkerCluster of awesome-marker pins, or with cluster=False a
+    GeoJson layer of circle markers of the given radius, in the colors'
+    css_color(). options go to the layer.
+    """
+    located = _columns(frame, lat, lng, popup, tooltip, color, category,
+                       colors)
+    if cluster:
+        return plugins.FastMarkerCluster(
+            rows(located), callback=_CALLBACK % json.dumps(icon), name=name,
+            **options)
+    located['color'] = located['color'].map(css_color)
+    collection = features(located, 'lat', 'lng',
+                          ['popup', 'tooltip', 'color'])
+    return folium.GeoJson(
+        collection, name=name,
+        marker=folium.CircleMarker(radius=radius, fill=True,
+                                   fill_opacity=0.8),
+        style_function=lambda feature: {
+            'color': feature['properties']['color'],
+            'fillColor': feature['properties']['color']},
+        popup=folium.GeoJsonPopup(['popup'], labels=False)
+        if popup is not None else None,
+        tooltip=folium.GeoJsonTooltip(['tooltip'], labels=False)
+        if tooltip is not None else None, **options)
+
+
+def heat_data(frame, lat='lat', lng='lng', weight=None):
+    """
+    Returns [[lat, lng]] (or [[lat, lng, weight]]) for every located row,
+    as folium.plugins.HeatMap takes it.
+    """
+    frame = _located(frame, lat, lng)
+    columns = [lat, lng] + ([weight] if weight is not None else [])
+    if weight is not None:
+        frame = frame[frame[weight].notna()]
+    return frame[columns].astype(float).to_numpy().tolist()
+
+
+def heatmap(frame, lat='lat', lng='lng', weight=None, **options):
+    """
+    Returns a folium.plugins.HeatMap of frame's locations, weighted by a
+    column if weight is given; options go to HeatMap.
+    """
+    return plugins.HeatMap(heat_data(frame, lat, lng, weight), **options)
+
+
+class ZoomHeatMap(plugins.HeatMap):
+    """
+    A HeatMap that holds different data for every zoom level and shows the
+    level nearest the map's zoom.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.heatLayer(
+                [], {{ this.options|tojavascript }});
+            (function (layer, levels) {
+                var zooms = Object.keys(levels).map(Number);
+                function update() {
+                    var zoom = layer._map.getZoom();
+                    var nearest = zooms.reduce(function (best, level) {
+                        return Math.abs(level - zoom) < Math.abs(best - zoom)
+                            ? level : best;
+                    }, zooms[0]);
+                    layer.setLatLngs(levels[nearest]);
+                }
+                layer.on('add', function () {
+                    layer._map.on('zoomend', update);
+                    update();
+                });
+                layer.on('remove', function () {
+                    layer._map.off('zoomend', update);
+                });
+            })({{ this.get_name() }}, {{ this.levels|tojson }});
+        {% endmacro %}
+        """)
+
+    def __init__(self, levels, name=None, max_zoom=1, **options):
+        # The cells are weighted for their own zoom level already, so the
+        # layer mustn't scale them down when zoomed out (see max_zoom).
+        rows = dict((zoom, heat_data(level, weight='weight')
+                     if isinstance(level, pd.DataFrame) else list(level))
+                    for zoom, level in levels.items())
+        if not rows:
+            raise ValueError('No zoom levels to draw')
+        super(ZoomHeatMap, self).__init__(rows[min(rows)], name=name,
+                                          max_zoom=max_zoom, **options)
+        self.levels = dict((str(zoom), level) for zoom, level in rows.items())
+
+
+def zoom_heatmap(levels, **options):
+    """
+    Returns a ZoomHeatMap of {zoom: cells}, where cells is a DataFrame of
+    lat, lng and weight (such as hubway_grid.Grid.levels()) or a list of
+    [lat, lng, weight]; options go to HeatMap.
+    """
+    return ZoomHeatMap(levels, **options)
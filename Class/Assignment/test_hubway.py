@@ -0,0 +1,323 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import hubway
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REAL_DATABASE = os.path.join(HERE, hubway.DATABASE)
+
+# (bins, lo, hi), including ranges whose edges fall on trip durations.
+RANGES = [(10, None, None), (86, 36, 2838), (72, 374, 2507), (100, 0, 3600),
+          (7, 60, 60), (13, 100.5, 1999.25)]
+
+
+@pytest.fixture(scope='module')
+def durations_db(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('hubway') / 'hubway.db')
+    durations = np.random.default_rng(0).integers(0, 20000, 300000)
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE trips (id INTEGER PRIMARY KEY, '
+                       'duration INTEGER, sub_type TEXT)')
+    connection.executemany(
+        'INSERT INTO trips (duration, sub_type) VALUES (?, ?)',
+        [(int(duration), 'Casual' if duration % 3 else 'Registered')
+         for duration in durations] + [(None, 'Casual')])
+    connection.commit()
+    connection.close()
+    yield path
+    hubway.get_service(path).close()
+
+
+def _check_histogram(path, bins, lo, hi, where=None, monkeypatch=None):
+    if monkeypatch is not None:
+        # Only the bins and the durations that fall on an edge come back.
+        run_query = hubway.run_query
+
+        def counted(*args, **options):
+            result = run_query(*args, **options)
+            assert len(result) <= 2 * bins + 1
+            return result
+        monkeypatch.setattr(hubway, 'run_query', counted)
+    query = 'SELECT duration FROM trips WHERE duration IS NOT NULL'
+    if where:
+        query += ' AND ' + where
+    connection = sqlite3.connect(path)
+    durations = np.array([row[0] for row in connection.execute(query)])
+    connection.close()
+    counts, edges = hubway.duration_histogram(bins, lo, hi, where=where,
+                                              path=path)
+    low = durations.min() if lo is None else lo
+    high = durations.max() if hi is None else hi
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    expected, expected_edges = np.histogram(durations, bins, (low, high))
+    np.testing.assert_array_equal(edges, expected_edges)
+    np.testing.assert_array_equal(counts, expected)
+
+
+@pytest.mark.parametrize('bins, lo, hi', RANGES)
+def test_duration_histogram_matches_numpy(durations_db, bins, lo, hi,
+                                          monkeypatch):
+    _check_histogram(durations_db, bins, lo, hi, monkeypatch=monkeypatch)
+
+
+def test_duration_histogram_where(durations_db):
+    _check_histogram(durations_db, 50, 0, 5000, where="sub_type = 'Casual'")
+
+
+@pytest.mark.skipif(not os.path.exists(REAL_DATABASE),
+                    reason='hubway.db has not been downloaded')
+@pytest.mark.parametrize('bins, lo, hi', RANGES)
+def test_duration_histogram_matches_numpy_on_hubway(bins, lo, hi):
+    _check_histogram(REAL_DATABASE, bins, lo, hi)
+
+
+def test_query_cache_is_bounded_by_bytes(durations_db):
+    service = hubway.QueryService(durations_db, cache_bytes=64 * 1024,
+                                  max_result_bytes=32 * 1024)
+    try:
+        big = service.run_query('SELECT duration FROM trips')
+        assert len(big) == 300001
+        assert service.stats()['entries'] == 0
+        assert service.stats()['uncached'] == 1
+        for limit in range(1, 40):
+            service.run_query('SELECT duration FROM trips LIMIT ?',
+                              (limit * 50,))
+        stats = service.stats()
+        assert 0 < stats['bytes'] <= 64 * 1024
+        assert stats['evictions'] > 0
+        cached = service.run_query('SELECT duration FROM trips LIMIT ?',
+                                   (39 * 50,))
+        assert service.stats()['hits'] == 1
+        cached['duration'] = 0
+        assert service.run_query('SELECT duration FROM trips LIMIT ?',
+                                 (39 * 50,))['duration'].any()
+    finally:
+        service.close()
+
+
+def test_approximate_without_samples_is_exact_and_read_only(durations_db):
+    import hubway_samples
+    query = "SELECT COUNT(*), AVG(duration) FROM trips WHERE sub_type = ?"
+    with pytest.warns(UserWarning, match='scans every trip'):
+        estimate = hubway.run_query(query, ('Casual',), path=durations_db,
+                                    approximate=0.01)
+    exact = hubway.run_query(query, ('Casual',), path=durations_db)
+    assert estimate['estimate'].tolist() == exact.iloc[0].tolist()
+    assert not estimate['stderr'].any()
+    connection = sqlite3.connect(durations_db)
+    tables = [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")]
+    connection.close()
+    assert tables == ['trips']
+    assert not hubway_samples.fresh(0.01, durations_db)
+
+
+def test_query_cache_keys_parameters_by_type(tmp_path):
+    path = str(tmp_path / 'types.db')
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE t (v INTEGER)')
+    connection.execute('INSERT INTO t VALUES (1)')
+    connection.commit()
+    connection.close()
+    service = hubway.QueryService(path)
+    try:
+        query = 'SELECT v / ? AS r FROM t'
+        assert service.run_query(query, (2,))['r'][0] == 0
+        assert service.run_query(query, (2.0,))['r'][0] == 0.5
+        assert service.run_query(query, (True,))['r'][0] == 1
+        named = 'SELECT v / :d AS r FROM t'
+        assert service.run_query(named, {'d': 2})['r'][0] == 0
+        assert service.run_query(named, {'d': 2.0})['r'][0] == 0.5
+        assert service.stats()['hits'] == 0
+    finally:
+        service.close()
+
+
+def test_markers_render_missing_values_as_null():
+    folium = pytest.importorskip('folium')
+    import map_layers
+    stations = pd.DataFrame({'lat': [42.35, 42.36, None],
+                             'lng': [-71.06, -71.07, -71.08],
+                             'station': ['A', 'B', 'C'],
+                             'color': ['red', None, 'blue']})
+    for options in ({'popup': 'station'}, {'tooltip': 'station'},
+                    {'popup': 'station', 'color': 'color'},
+                    {'popup': 'station', 'color': 'color', 'cluster': False}):
+        stops = folium.Map()
+        map_layers.markers(stations, **options).add_to(stops)
+        html = stops.get_root().render()
+        data = [line for line in html.splitlines() if 'var data' in line]
+        assert 'NaN' not in html
+        assert not options.get('cluster', True) or data
+
+
+@pytest.mark.parametrize('rate', [0.05, True, 1])
+def test_approximate_rejects_unknown_rates(durations_db, rate):
+    with pytest.raises(ValueError):
+        hubway.run_query('SELECT COUNT(*) FROM trips', path=durations_db,
+                         approximate=rate)
+
+
+# Literals for every field boundary, a literal that isn't in the stored
+# format (left alone) and times stored exactly on those boundaries.
+DATE_LITERALS = ['2012-03-01 10:00:00', '2012-03-01 10:00', '2012-03-01 10',
+                 '2012-03-01', '2012-03', '2012', '2012-03-01T10:00']
+BOUNDARY_TIMES = ['2012-03-01 10:00:00', '2012-03-01 10:00:59',
+                  '2012-03-01 10:59:59', '2012-03-01 00:00:00',
+                  '2012-02-29 23:59:59', '2012-03-31 23:59:59',
+                  '2012-01-01 00:00:00', '2011-12-31 23:59:59',
+                  '2012-12-31 23:59:59', '2013-01-01 00:00:00']
+
+
+@pytest.fixture(scope='module')
+def dates_db(tmp_path_factory):
+    import hubway_timestamps
+    path = str(tmp_path_factory.mktemp('timestamps') / 'hubway.db')
+    start = np.datetime64('2011-10-01T00:00:00')
+    offsets = np.random.default_rng(1).integers(0, 500 * 86400, 20000)
+    times = [str(time).replace('T', ' ')
+             for time in start + offsets.astype('timedelta64[s]')]
+    times += BOUNDARY_TIMES
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE trips (id INTEGER PRIMARY KEY, '
+                       'start_date TEXT, end_date TEXT, duration INTEGER)')
+    connection.executemany(
+        'INSERT INTO trips (start_date, end_date, duration) VALUES (?, ?, 1)',
+        [(time, time) for time in times])
+    connection.commit()
+    connection.close()
+    hubway_timestamps.migrate(path)
+    yield path
+    hubway.get_service(path).close()
+
+
+def _count(path, query):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(query).fetchone()[0]
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize('operator', ['<', '<=', '>', '>='])
+@pytest.mark.parametrize('literal', DATE_LITERALS)
+def test_timestamp_rewrite_keeps_comparisons(dates_db, operator, literal):
+    import hubway_timestamps
+    query = ("SELECT COUNT(*) FROM trips WHERE trips.start_date {0} '{1}'"
+             .format(operator, literal))
+    rewritten = hubway_timestamps.rewrite(query)
+    assert ('start_ts' in rewritten) == ('T' not in literal)
+    assert _count(dates_db, rewritten) == _count(dates_db, query)
+
+
+@pytest.mark.parametrize('low, high', [
+    ('2012-03-01 10:00:00', '2012-03-01 10:59:59'),
+    ('2012-03-01', '2012-03-31'), ('2012-02', '2012-03'), ('2012', '2012'),
+    ('2012-03-01T00:00', '2012-03-31')])
+def test_timestamp_rewrite_keeps_between(dates_db, low, high):
+    import hubway_timestamps
+    query = ('SELECT COUNT(*) FROM trips WHERE end_date BETWEEN "{0}" AND '
+             '"{1}"'.format(low, high))
+    rewritten = hubway_timestamps.rewrite(query)
+    assert ('end_ts' in rewritten) == ('T' not in low + high)
+    assert _count(dates_db, rewritten) == _count(dates_db, query)
+    assert hubway_timestamps.run_query(query, path=dates_db).iloc[0, 0] == \
+        _count(dates_db, query)
+
+
+# The notebook's aggregates that hubway_summaries answers from summaries.
+SUMMARY_QUERIES = [
+    '''SELECT stations.station AS "Station", COUNT(*) AS "Count"
+       FROM trips INNER JOIN stations ON trips.start_station = stations.id
+       GROUP BY stations.station ORDER BY COUNT(*) DESC''',
+    '''SELECT stations.station AS "Station", COUNT(*) AS "Count",
+       stations.lat, stations.lng FROM trips
+       INNER JOIN stations ON trips.start_station = stations.id
+       WHERE trips.start_station = trips.end_station
+       GROUP BY stations.station ORDER BY COUNT(*) DESC''',
+    '''SELECT stations.station AS "Station", trips.sub_type , COUNT(*) AS "Count"
+       FROM trips INNER JOIN stations ON trips.start_station = stations.id
+       WHERE trips.start_station = trips.end_station
+       GROUP BY stations.station, trips.sub_type ORDER BY COUNT(*) DESC;''',
+    '''SELECT bike_number as "Bike Number", COUNT(*) AS "Number of Trips",
+       SUM(duration)/3600 as "Total Ridden Time (Hrs)" FROM trips
+       GROUP BY bike_number ORDER BY COUNT(*) DESC''',
+    '''SELECT start.municipality AS "Municipality",
+       AVG(trips.duration) AS "Duration" FROM trips
+       INNER JOIN stations AS start ON trips.start_station = start.id
+       INNER JOIN stations AS end ON trips.end_station = end.id
+       WHERE start.municipality = end.municipality
+       GROUP BY start.municipality ORDER BY AVG(trips.duration) DESC;''']
+
+
+def _trips(rng, count):
+    return [(int(rng.integers(1, 30)), int(rng.integers(1, 30)),
+             'B{0:03d}'.format(rng.integers(0, 50)),
+             ['Casual', 'Registered'][rng.integers(0, 2)],
+             None if rng.random() < 0.05 else int(rng.integers(60, 9000)))
+            for _ in range(count)]
+
+
+def _insert_trips(path, trips):
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        'INSERT INTO trips (start_station, end_station, bike_number, '
+        'sub_type, duration) VALUES (?, ?, ?, ?, ?)', trips)
+    connection.commit()
+    connection.close()
+
+
+def _check_summary_queries(path, rewritten):
+    import hubway_summaries
+    connection = sqlite3.connect(path)
+    try:
+        for query in SUMMARY_QUERIES:
+            assert (hubway_summaries.rewrite(hubway._normalize(query), path)
+                    is not None) == rewritten
+            result = hubway.run_query(query, path=path)
+            expected = pd.read_sql_query(query, connection)
+            # Rows that tie on the ORDER BY may come out in either order.
+            columns = list(expected.columns)
+            pd.testing.assert_frame_equal(
+                result.sort_values(columns).reset_index(drop=True),
+                expected.sort_values(columns).reset_index(drop=True))
+    finally:
+        connection.close()
+
+
+def test_summaries_answer_like_trips(tmp_path):
+    import hubway_summaries
+    path = str(tmp_path / 'hubway.db')
+    rng = np.random.default_rng(2)
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE stations (id INTEGER PRIMARY KEY, '
+                       'station TEXT, municipality TEXT, lat REAL, lng REAL)')
+    connection.executemany(
+        'INSERT INTO stations VALUES (?, ?, ?, ?, ?)',
+        [(id, 'Station {0}'.format(id), ['Boston', 'Cambridge',
+                                         'Somerville'][id % 3],
+          42 + id / 100.0, -71 - id / 100.0) for id in range(1, 30)])
+    connection.execute('CREATE TABLE trips (id INTEGER PRIMARY KEY, '
+                       'start_station INTEGER, end_station INTEGER, '
+                       'bike_number TEXT, sub_type TEXT, duration INTEGER)')
+    connection.commit()
+    connection.close()
+    _insert_trips(path, _trips(rng, 5000))
+    try:
+        _check_summary_queries(path, rewritten=False)
+        hubway_summaries.refresh(path)
+        _check_summary_queries(path, rewritten=True)
+        # Stale summaries are never read, and reading doesn't refresh them.
+        _insert_trips(path, _trips(rng, 700))
+        _check_summary_queries(path, rewritten=False)
+        assert not hubway_summaries._current(path)
+        folded = hubway_summaries.refresh(path)
+        assert set(folded.values()) == {700}
+        _check_summary_queries(path, rewritten=True)
+    finally:
+        hubway.get_service(path).close()